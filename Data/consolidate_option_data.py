@@ -1,61 +1,183 @@
+import argparse
 import concurrent.futures as fut
 import os
 from pathlib import Path
+from typing import Optional
 
 import pandas as pd
+import polars as pl
+
+from Data.manifest import WrittenContractIndex
 from backtest.utilities.option_info import OptionMetadata
-from backtest.utilities.utils import parse_args, read_universe_list
+from backtest.utilities.utils import load_credentials, read_universe_list
+
+_CONSOLIDATED_SCHEMA = {
+    "timestamp": pl.Int64,
+    "open": pl.Float64,
+    "high": pl.Float64,
+    "low": pl.Float64,
+    "close": pl.Float64,
+    "volume": pl.Float64,
+    "symbol": pl.String,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Consolidate raw per-contract option bars into per-underlying history.")
+    parser.add_argument("-c", "--credentials", required=False, type=str, help="filepath to credentials.json")
+    parser.add_argument("--universe", type=Path, required=True, help="File path to trading universe", nargs="+")
+    parser.add_argument("--frequency", type=str, required=True, help="Frequency of data. Searches a dir with same name")
+    parser.add_argument("--num-workers", type=int, default=8, help="Underlyings consolidated in parallel")
+    return parser.parse_args()
+
+
+def get_consolidated_fp(frequency, underlying, expiry_month: str) -> Path:
+    # one parquet partition per underlying and expiry month (YYYY-MM)
+    return Path(os.environ["DATA_DIR"]) / f"{frequency}/options/{underlying}/{expiry_month}.parquet"
+
+
+def get_legacy_consolidated_fp(frequency, underlying) -> Path:
+    # single csv per underlying, written before the parquet partitions
+    return Path(os.environ["DATA_DIR"]) / f"{frequency}/options/{underlying}_options.csv"
+
+
+def _expiry_month(expiration_date) -> Optional[str]:
+    return None if pd.isna(expiration_date) else pd.Timestamp(expiration_date).strftime("%Y-%m")
 
 
 def _get_eto_df_with_sym(eto_sym, freq):
     fp = Path(os.environ["DATA_DIR"]) / f"{freq}/options_raw/{eto_sym}.csv"
     if not fp.exists():
-        return pd.DataFrame()
+        return None
     try:
-        df = pd.read_csv(fp)
-        df["symbol"] = eto_sym
-        return df
+        df = pl.read_csv(fp).select([c for c in _CONSOLIDATED_SCHEMA.keys() if c != "symbol"])
+        return df.with_columns(pl.lit(eto_sym).alias("symbol")).cast(_CONSOLIDATED_SCHEMA)
     except Exception as e:
         print(f"Exception on {fp}")
         print(e)
-        return pd.DataFrame()
+        return None
 
 
-def consolidate_option_sym_df(underlying_list, frequency):
-    base_universe_dir = Path(os.environ["DATA_DIR"])
-    for und in underlying_list:
-        print(und)
-        underlying_option_metadata_df = OptionMetadata().get_option_metadata_for_symbol(und)
-        unique_tickers = underlying_option_metadata_df.ticker.unique()
-        if len(unique_tickers) == 0:
-            continue
-        res = []
-        with fut.ThreadPoolExecutor(8) as exec:
-            res = [exec.submit(_get_eto_df_with_sym, eto_sym, frequency) for eto_sym in unique_tickers]
-            res = [r.result() for r in res]
-        df = pd.concat(res)
-        if df.empty:
+def _commit_partition(fp: Path, df: pl.DataFrame):
+    """Merges df into the partition at fp through a temp file + rename, then checks every new row landed"""
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    if fp.exists():
+        df = pl.concat([pl.read_parquet(fp).cast(_CONSOLIDATED_SCHEMA), df])
+    df = df.unique(subset=["symbol", "timestamp"], keep="last").sort(["symbol", "timestamp"])
+    tmp_fp = fp.with_suffix(".tmp")
+    df.write_parquet(tmp_fp)
+    with open(tmp_fp, "rb") as fin:
+        os.fsync(fin.fileno())
+    os.replace(tmp_fp, fp)
+
+
+def _verify_partition(fp: Path, df: pl.DataFrame) -> bool:
+    committed = pl.scan_parquet(fp).select(["symbol", "timestamp"])
+    return df.select(["symbol", "timestamp"]).join(committed.collect(), on=["symbol", "timestamp"], how="anti").is_empty()
+
+
+def _group_by_month(expiry_months: dict) -> dict:
+    by_month = {}
+    for eto_sym, expiry_month in expiry_months.items():
+        if expiry_month is None:
+            print(f"{eto_sym}: no expiration date, skipped")
             continue
+        by_month.setdefault(expiry_month, []).append(eto_sym)
+    return by_month
+
+
+def _commit_by_month(und, frequency, month_dfs: dict) -> list:
+    """Commits and verifies each {expiry_month: df} partition, returns the expiry months that landed"""
+    committed_months = []
+    for expiry_month, month_df in month_dfs.items():
+        fp = get_consolidated_fp(frequency, und, expiry_month)
         try:
-            fp_to_write = base_universe_dir / f"{frequency}/options/{und}_options.csv"
-            df = df.sort_values(["symbol", "timestamp"])
-            if fp_to_write.exists():
-                existing_df = pd.read_csv(fp_to_write)
-                df = pd.concat([existing_df[df.columns], df]).drop_duplicates(keep='last')
-            if not df.empty:
-                df.to_csv(fp_to_write, index=False)
+            _commit_partition(fp, month_df)
+            if not _verify_partition(fp, month_df):
+                raise Exception(f"verification failed for {fp}")
         except Exception as e:
-            print(f"Exception: {und}\n{df.head()}")
-            print(e)
-            raise Exception()
+            print(f"Exception: {und} {expiry_month}\n{e}")
+            continue
+        committed_months.append(expiry_month)
+    return committed_months
+
+
+def migrate_legacy_consolidated(und, ticker_expiry: dict, frequency) -> list:
+    """
+    One-time move of a legacy {und}_options.csv into the expiry month partitions. Rows of contracts without
+    a known expiry stay in the csv, which is deleted once it is empty. Returns the migrated contracts.
+    """
+    legacy_fp = get_legacy_consolidated_fp(frequency, und)
+    if not legacy_fp.exists():
+        return []
+    try:
+        legacy_df = pl.read_csv(legacy_fp).select(list(_CONSOLIDATED_SCHEMA.keys())).cast(_CONSOLIDATED_SCHEMA)
+    except Exception as e:
+        print(f"Could not read legacy {legacy_fp}:\n{e}")
+        return []
+    expiry_months = {sym: _expiry_month(ticker_expiry.get(sym)) for sym in legacy_df["symbol"].unique().to_list()}
+    month_dfs = {
+        expiry_month: legacy_df.filter(pl.col("symbol").is_in(syms))
+        for expiry_month, syms in _group_by_month(expiry_months).items()
+    }
+    committed_months = set(_commit_by_month(und, frequency, month_dfs))
+    migrated_syms = [sym for sym, expiry_month in expiry_months.items() if expiry_month in committed_months]
+    remaining_df = legacy_df.filter(~pl.col("symbol").is_in(migrated_syms))
+    if remaining_df.is_empty():
+        legacy_fp.unlink()
+    else:
+        tmp_fp = legacy_fp.with_suffix(".tmp")
+        remaining_df.write_csv(tmp_fp)
+        os.replace(tmp_fp, legacy_fp)
+        print(f"{legacy_fp}: {remaining_df['symbol'].n_unique()} contracts without a committed expiry month left")
+    return migrated_syms
+
+
+def consolidate_underlying(und, ticker_expiry: dict, frequency) -> list:
+    """
+    Consolidates the raw contract files of one underlying. Raw files are only deleted after every partition
+    they feed has been committed and verified, so a crash at any point leaves the data either still raw
+    or already consolidated, never lost or doubled.
+    """
+    migrated_syms = migrate_legacy_consolidated(und, ticker_expiry, frequency)
+    raw_dfs = {}
+    for eto_sym in ticker_expiry.keys():
+        df = _get_eto_df_with_sym(eto_sym, frequency)
+        if df is not None and not df.is_empty():
+            raw_dfs[eto_sym] = df
+    if not raw_dfs:
+        return migrated_syms
+
+    by_month = _group_by_month({eto_sym: _expiry_month(ticker_expiry[eto_sym]) for eto_sym in raw_dfs})
+    month_dfs = {expiry_month: pl.concat([raw_dfs[sym] for sym in syms]) for expiry_month, syms in by_month.items()}
+    committed_months = _commit_by_month(und, frequency, month_dfs)
+    committed_syms = [eto_sym for expiry_month in committed_months for eto_sym in by_month[expiry_month]]
+
+    for eto_sym in committed_syms:
+        (Path(os.environ["DATA_DIR"]) / f"{frequency}/options_raw/{eto_sym}.csv").unlink(missing_ok=True)
+    return list(dict.fromkeys(migrated_syms + committed_syms))
+
 
-        for eto_sym in underlying_option_metadata_df.ticker.unique():
-            fp = base_universe_dir / f"{frequency}/options_raw/{eto_sym}.csv"
-            if fp.exists():
-                fp.unlink()
+def consolidate_option_sym_df(underlying_list, frequency, num_workers=8):
+    option_metadata = OptionMetadata()
+    written_index = WrittenContractIndex()
+    with fut.ProcessPoolExecutor(num_workers) as p:
+        futures = {}
+        for und in underlying_list:
+            und_df = option_metadata.get_option_metadata_for_symbol(und)
+            if und_df.empty:
+                continue
+            ticker_expiry = dict(zip(und_df["ticker"], und_df["expiration_date"]))
+            futures[p.submit(consolidate_underlying, und, ticker_expiry, frequency)] = und
+        for f in fut.as_completed(futures):
+            committed_syms = f.result()
+            written_index.add(frequency, committed_syms)
+            print(futures[f], f"{len(committed_syms)} contracts consolidated")
 
 
 if __name__ == "__main__":
     args = parse_args()
+    if args.credentials is not None:
+        load_credentials(args.credentials, into_env=True)
     universe_list = read_universe_list(args.universe)
-    consolidate_option_sym_df(universe_list, args.frequency)
+    consolidate_option_sym_df(universe_list, args.frequency, args.num_workers)
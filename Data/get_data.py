@@ -1,16 +1,20 @@
 import argparse
-import concurrent.futures as fut
 import datetime
 import importlib
+import io
 import os
 from pathlib import Path
 import subprocess
-import time
+import threading
 
 import pandas as pd
 
-from Data.source.base.DataGetter import OHLC_COLUMNS, DataGetter, get_ohlc_fp
+from Data.manifest import DownloadManifest, WrittenContractIndex
+from Data.source.base.DataGetter import OHLC_COLUMNS, DataGetter, get_ohlc_fp, read_ohlc, write_ohlc_parquet
+from Data.writer_pipeline import WriterPipeline
 from backtest.utilities.option_info import get_option_ticker_from_underlying
+from backtest.utilities.resample import bucket_start_ms, parse_frequency, resample_bars
+from backtest.utilities.scheduler import DOWNLOAD_SETTLE, BarScheduler, end_of_trading_week
 from backtest.utilities.utils import (
     DATA_GETTER_INST_TYPES,
     get_ms_from_datetime,
@@ -22,8 +26,19 @@ from trading.utilities.utils import NY_TIMEZONE
 # change this for intended start date
 data_from = datetime.datetime(2023, 1, 1)
 data_to = datetime.datetime.now()
-DERIVE_START_MS_FROM_FILE = False
+# only request the [from_ms, to_ms) ranges that Data/manifest.py has not recorded as downloaded
+USE_DOWNLOAD_MANIFEST = True
 WRITE_NEW_SYMBOLS_ONLY = True
+# "parquet" once DATA_DIR has been converted with Data/migrate_to_parquet.py
+OHLC_STORE_FORMAT = "csv"
+# late corrections to bars within this window of the last stored bar are merged in on incremental writes
+WRITE_OVERLAP_MS = 2 * 60 * 60 * 1000
+# fetched option bars waiting to be written are capped at WRITER_QUEUE_SIZE, which bounds peak memory
+WRITER_THREADS = 8
+WRITER_QUEUE_SIZE = 256
+# live runs download only the base frequency and derive the coarser ones from it locally
+LIVE_BASE_FREQUENCY = "5minute"
+LIVE_DERIVED_FREQUENCIES = {"equity": ["15minute", "30minute", "day"], "options": ["15minute", "day"]}
 
 
 def parse_args():
@@ -59,7 +74,75 @@ def get_and_write_stock_symbols(getter, exchange):
         f.write("\n".join(stockList))
 
 
-def _write_ohlc(symbol, multiplier, time_scale, inst_type, df):
+def _find_csv_tail_offset(fp: Path, cutoff_ts: int, block_size: int = 1 << 16):
+    """
+    Scans an ohlc csv (sorted by its leading timestamp column) backwards from the end and returns the
+    byte offset of the first row with timestamp >= cutoff_ts, together with the last stored timestamp.
+    """
+    with open(fp, "rb") as fin:
+        end = fin.seek(0, os.SEEK_END)
+        pos = end
+        while True:
+            pos = max(0, pos - block_size)
+            fin.seek(pos)
+            lines = fin.read(end - pos).split(b"\n")
+            # the first line of a block can be partial, the first line of the file is the header
+            row_offset = pos + len(lines[0]) + 1
+            rows = [line for line in lines[1:] if line]
+            if not rows:
+                if pos == 0:
+                    return row_offset, None
+                block_size *= 2
+                continue
+            timestamps = [int(float(row.split(b",", 1)[0])) for row in rows]
+            if timestamps[0] < cutoff_ts or pos == 0:
+                break
+            block_size *= 2
+    for row, ts in zip(rows, timestamps):
+        if ts >= cutoff_ts:
+            break
+        row_offset += len(row) + 1
+    return row_offset, timestamps[-1]
+
+
+def _get_tail_journal_fp(fp: Path) -> Path:
+    return fp.with_name(fp.name + ".tail")
+
+
+def _apply_csv_tail(fp: Path):
+    """
+    Replays a tail rewrite recorded by _write_csv_tail: truncates fp at the recorded offset and appends the
+    recorded rows. Idempotent, so a rewrite interrupted at any point is completed by applying it again.
+    """
+    journal_fp = _get_tail_journal_fp(fp)
+    with open(journal_fp, "rb") as fin:
+        offset = int(fin.readline())
+        tail_bytes = fin.read()
+    with open(fp, "r+b") as fout:
+        fout.truncate(offset)
+        fout.seek(offset)
+        fout.write(tail_bytes)
+    journal_fp.unlink()
+
+
+def _write_csv_tail(fp: Path, offset: int, df: pd.DataFrame):
+    # the new tail is first written to a journal next to fp, so a crash between truncate and append is recoverable
+    journal_fp = _get_tail_journal_fp(fp)
+    tmp_fp = journal_fp.with_name(journal_fp.name + ".tmp")
+    with open(tmp_fp, "w") as fout:
+        fout.write(f"{offset}\n")
+        df.loc[:, OHLC_COLUMNS].to_csv(fout, header=False)
+    os.replace(tmp_fp, journal_fp)
+    _apply_csv_tail(fp)
+
+
+def _write_ohlc(symbol, multiplier, time_scale, inst_type, df, compact=False):
+    """
+    Incremental by default: bars newer than the last stored timestamp are appended, and bars within
+    WRITE_OVERLAP_MS of it are treated as late corrections by rewriting only that tail of the file.
+    Older bars are dropped (and logged), a compact=True write merges and rewrites the whole file instead.
+    Returns the timestamp bars were persisted from when older ones were dropped, else None.
+    """
     ohlc_types = {
         "timestamp": "int64",
         "volume": "float64",
@@ -72,18 +155,95 @@ def _write_ohlc(symbol, multiplier, time_scale, inst_type, df):
     }
     if df.empty:
         return
-    fp = get_ohlc_fp(multiplier, time_scale, symbol, inst_type)
+    fp = get_ohlc_fp(multiplier, time_scale, symbol, inst_type, compression=OHLC_STORE_FORMAT)
+    if OHLC_STORE_FORMAT == "parquet":
+        write_ohlc_parquet(fp, df)
+        return
+    df = df.astype({k: v for k, v in ohlc_types.items() if k in df.columns})
+    if _get_tail_journal_fp(fp).exists():
+        print(f"Completing interrupted tail write of {fp}")
+        _apply_csv_tail(fp)
+    if fp.exists() and not compact:
+        try:
+            offset, last_ts = _find_csv_tail_offset(fp, int(df.timestamp.max()) - WRITE_OVERLAP_MS)
+        except Exception as e:
+            print(f"Could not find tail of {fp}, compacting instead:\n{e}")
+            return _write_ohlc(symbol, multiplier, time_scale, inst_type, df, compact=True)
+        kept_from_ms = None
+        if last_ts is not None:
+            kept_from_ms = last_ts - WRITE_OVERLAP_MS
+            num_dropped = int((df.timestamp < kept_from_ms).sum())
+            if num_dropped:
+                print(
+                    f"{fp}: dropped {num_dropped} bars in [{df.timestamp.min()}, {kept_from_ms}) older than the "
+                    f"stored tail, a compacting (non-live) run merges them in"
+                )
+            else:
+                kept_from_ms = None
+            df = df.loc[df.timestamp >= last_ts - WRITE_OVERLAP_MS]
+            if df.empty:
+                return kept_from_ms
+            offset, _ = _find_csv_tail_offset(fp, int(df.timestamp.min()))
+        with open(fp, "rb") as fin:
+            fin.seek(offset)
+            tail_bytes = fin.read()
+        if tail_bytes:
+            tail_df = pd.read_csv(io.BytesIO(tail_bytes), names=["timestamp"] + OHLC_COLUMNS, header=None)
+            df = pd.concat([tail_df, df]).drop_duplicates(subset=["timestamp"], keep="last")
+        _write_csv_tail(fp, offset, df.set_index("timestamp", drop=True).sort_index())
+        return kept_from_ms
     if fp.exists():
         try:
-            existing_df = pd.read_csv(fp).astype(ohlc_types)
-            df = df.astype(ohlc_types)
+            existing_df = pd.read_csv(fp)
+            existing_df = existing_df.astype({k: v for k, v in ohlc_types.items() if k in existing_df.columns})
         except Exception as e:
             print(f"Could not write into {fp}:\n{e}")
             return
-        
+
         df = pd.concat([existing_df, df]).drop_duplicates(subset=["timestamp"], keep="last")
     df = df.set_index('timestamp', drop=True).sort_index()
-    df.loc[:, OHLC_COLUMNS].to_csv(fp)
+    # prefixed rather than suffixed, so to_csv still infers the compression from the extension
+    tmp_fp = fp.with_name(f".tmp.{fp.name}")
+    df.loc[:, OHLC_COLUMNS].to_csv(tmp_fp)
+    os.replace(tmp_fp, fp)
+
+
+def _read_ohlc_tail(fp: Path, from_ms: int) -> pd.DataFrame:
+    # csv files are only read from the first row >= from_ms rather than parsed whole
+    if OHLC_STORE_FORMAT == "parquet" or not fp.exists():
+        return read_ohlc(fp, from_ms=from_ms)
+    offset, _ = _find_csv_tail_offset(fp, from_ms)
+    with open(fp, "rb") as fin:
+        fin.seek(offset)
+        tail_bytes = fin.read()
+    if not tail_bytes:
+        return pd.DataFrame(columns=["timestamp"] + OHLC_COLUMNS)
+    return pd.read_csv(io.BytesIO(tail_bytes), names=["timestamp"] + OHLC_COLUMNS, header=None)
+
+
+def _write_derived_ohlc(symbol, inst_type, base_freq, derived_freqs, since_ms):
+    """
+    Rebuilds the derived frequency bars of symbol touched by base bars from since_ms on. Only the buckets from
+    the one containing since_ms are resampled, _write_ohlc then replaces the stored trailing (open) bucket.
+    """
+    base_multiplier, base_time_scale = parse_frequency(base_freq)
+    base_fp = get_ohlc_fp(base_multiplier, base_time_scale, symbol, inst_type, compression=OHLC_STORE_FORMAT)
+    for freq in derived_freqs:
+        base_df = _read_ohlc_tail(base_fp, int(bucket_start_ms([since_ms], freq)[0]))
+        if base_df.empty:
+            continue
+        multiplier, time_scale = parse_frequency(freq)
+        _write_ohlc(symbol, multiplier, time_scale, inst_type, resample_bars(base_df, freq))
+
+
+def _add_to_manifest(manifest, inst_type, freq, symbol, start_ms, end_ms, kept_from_ms=None):
+    """Records [start_ms, end_ms) as downloaded, minus the head _write_ohlc dropped instead of persisting"""
+    if manifest is None:
+        return
+    if kept_from_ms is not None:
+        start_ms = max(start_ms, kept_from_ms)
+    if start_ms < end_ms:
+        manifest.add(inst_type, freq, symbol, start_ms, end_ms)
 
 
 def _store_option_data_into_history(freq: str):
@@ -103,25 +263,44 @@ def get_data_for_equity(args, underlying_universe_list):
     to_ms = get_ms_from_datetime(now if args.live else data_to)
     print(from_ms, to_ms)
     print("Num of sym to get: ", len(underlying_universe_list))
-    to_iterate = ["5minute", "15minute", "30minute", "day"] if args.live else args.frequency
+    manifest = DownloadManifest() if USE_DOWNLOAD_MANIFEST else None
+    to_iterate = [LIVE_BASE_FREQUENCY] if args.live else args.frequency
     for freq in to_iterate:
         sym_and_time_list = [
-            [(start_ms, end_ms, sym) for start_ms, end_ms in getter.equity_chop_dates(from_ms, to_ms, freq)]
-            # if args.source == "polygon"
-            # else [(from_ms, to_ms, sym)]
+            [
+                (start_ms, end_ms, sym)
+                for gap_from_ms, gap_to_ms in (
+                    manifest.missing("equity", freq, sym, from_ms, to_ms, pad_ms=WRITE_OVERLAP_MS if args.live else 0)
+                    if manifest is not None
+                    else [(from_ms, to_ms)]
+                )
+                for start_ms, end_ms in getter.equity_chop_dates(gap_from_ms, gap_to_ms, freq)
+            ]
             for sym in underlying_universe_list
         ]
         sym_and_time_list = [entry for combi in sym_and_time_list for entry in combi]
+        print(f"{freq}: {len(sym_and_time_list)} ranges to request")
         multiplier = int(freq.replace("minute", "")) if freq != "day" else 1
         time_scale = "minute" if "minute" in freq else "day"
-        with fut.ThreadPoolExecutor(16) as p:
-            res_df = [
-                p.submit(getter.get_ohlc, sym, multiplier, time_scale, start_ms, end_ms)
-                for start_ms, end_ms, sym in sym_and_time_list
-            ]
-            res_df = [r.result() for r in res_df]
-        for (_, _, sym), df in zip(sym_and_time_list, res_df):
-            _write_ohlc(sym, multiplier, time_scale, "equity", df)
+
+        def _on_result(request, df):
+            sym, _, _, start_ms, end_ms = request
+            kept_from_ms = _write_ohlc(sym, multiplier, time_scale, "equity", df, compact=not args.live)
+            if args.live and not df.empty:
+                _write_derived_ohlc(
+                    sym, "equity", freq, LIVE_DERIVED_FREQUENCIES["equity"], int(df.timestamp.min())
+                )
+            _add_to_manifest(manifest, "equity", freq, sym, start_ms, end_ms, kept_from_ms)
+
+        # writes and derived resampling run on the writer threads, the fetch loop only hands results off
+        pipeline = WriterPipeline(
+            _on_result, num_writers=WRITER_THREADS, max_queue=WRITER_QUEUE_SIZE, name=f"equity {freq}"
+        )
+        getter.stream_ohlc(
+            [(sym, multiplier, time_scale, start_ms, end_ms) for start_ms, end_ms, sym in sym_and_time_list],
+            pipeline.put_async,
+        )
+        pipeline.close()
         print(f"[{datetime.datetime.now()}] ", freq, "done")
 
 
@@ -129,6 +308,7 @@ def get_data_for_options(args, underlying_universe_list):
     # assert len(args.frequency) == 1, "get_data for option does not support multiple frequency"
     getter: DataGetter = get_source_instance("options")
     now = datetime.datetime.now()
+    written_index = WrittenContractIndex()
     if args.live:
         ticker_expiry_list = [
             (sym, expiry_dt)
@@ -146,14 +326,16 @@ def get_data_for_options(args, underlying_universe_list):
                 underlying_universe_list, data_from,data_to 
             ).items()
         ]
-        # TODO: get the symbol and expiring, compare against to_ms
         if WRITE_NEW_SYMBOLS_ONLY:
-            written_fp = list((Path(os.environ["DATA_DIR"]) / f"{args.frequency[0]}/options").glob("*_options.csv"))
-            if len(written_fp) != 0:
-                written_etos = set(pd.concat([pd.read_csv(fp, usecols=["symbol"]) for fp in written_fp]).symbol.unique())
-                ticker_expiry_list = [(k, v) for k, v in ticker_expiry_list if k not in written_etos]
+            written_etos = written_index.written(args.frequency[0])
+            if not written_etos:
+                written_index.rebuild_from_consolidated(args.frequency[0])
+                written_etos = written_index.written(args.frequency[0])
+            ticker_expiry_list = [(k, v) for k, v in ticker_expiry_list if k not in written_etos]
     print("Num of sym to get: ", len(ticker_expiry_list))
-    to_iterate = ["5minute", "15minute", "day"] if args.live else args.frequency
+    manifest = DownloadManifest() if USE_DOWNLOAD_MANIFEST else None
+    now_ms = get_ms_from_datetime(now)
+    to_iterate = [LIVE_BASE_FREQUENCY] if args.live else args.frequency
     chunk = 12000
     ticker_expiry_chunks = [
         ticker_expiry_list[i * chunk : (i + 1) * chunk] for i in range((len(ticker_expiry_list) + chunk - 1) // chunk)
@@ -163,22 +345,60 @@ def get_data_for_options(args, underlying_universe_list):
         print("starting", freq)
         multiplier = int(freq.replace("minute", "")) if freq != "day" else 1
         time_scale = "minute" if "minute" in freq else "day"
+
+        def _write(request, df):
+            sym, _, _, start_ms, end_ms = request
+            kept_from_ms = _write_ohlc(sym, multiplier, time_scale, "options", df, compact=not args.live)
+            if args.live and not df.empty:
+                # same writer thread as the base write, so derived files of a contract are never written concurrently
+                _write_derived_ohlc(
+                    sym, "options", freq, LIVE_DERIVED_FREQUENCIES["options"], int(df.timestamp.min())
+                )
+            _add_to_manifest(manifest, "options", freq, sym, start_ms, end_ms, kept_from_ms)
+            if kept_from_ms is None:
+                _mark_gap_written(sym)
+
+        # expired contracts -> gaps not written yet. A contract is only indexed as written once every one of
+        # its gaps has been, a failed fetch or write leaves it out so the next run retries it
+        pending_gaps = {}
+        pending_lock = threading.Lock()
+
+        def _mark_gap_written(sym):
+            with pending_lock:
+                if sym not in pending_gaps:
+                    return
+                pending_gaps[sym] -= 1
+                if pending_gaps[sym] > 0:
+                    return
+                del pending_gaps[sym]
+            written_index.add(freq, [sym])
+
+        pipeline = WriterPipeline(_write, num_writers=WRITER_THREADS, max_queue=WRITER_QUEUE_SIZE, name=f"options {freq}")
         for ticker_expiry_chunk in ticker_expiry_chunks:
-            with fut.ThreadPoolExecutor(32) as p:
-                res_df = [
-                    p.submit(
-                        getter.get_ohlc,
-                        sym,
-                        multiplier,
-                        time_scale,
-                        get_ms_from_datetime(expiry_dt - pd.Timedelta(100, "d")),
-                        get_ms_from_datetime(expiry_dt + pd.Timedelta(2, "d")),
+            sym_and_time_list = []
+            for sym, expiry_dt in ticker_expiry_chunk:
+                start_ms = get_ms_from_datetime(expiry_dt - pd.Timedelta(100, "d"))
+                contract_end_ms = get_ms_from_datetime(expiry_dt + pd.Timedelta(2, "d"))
+                end_ms = min(contract_end_ms, now_ms)
+                if manifest is None:
+                    gaps = [(start_ms, end_ms)]
+                else:
+                    gaps = manifest.missing(
+                        "options", freq, sym, start_ms, end_ms, pad_ms=WRITE_OVERLAP_MS if args.live else 0
                     )
-                    for sym, expiry_dt in ticker_expiry_chunk
-                ]
-                res_df = [r.result() for r in res_df]
-            for (sym, _), df in zip(ticker_expiry_chunk, res_df):
-                _write_ohlc(sym, multiplier, time_scale, "options", df)
+                if contract_end_ms < now_ms:
+                    if not gaps:
+                        written_index.add(freq, [sym])
+                    else:
+                        with pending_lock:
+                            pending_gaps[sym] = len(gaps)
+                sym_and_time_list.extend((gap_from_ms, gap_to_ms, sym) for gap_from_ms, gap_to_ms in gaps)
+            getter.stream_ohlc(
+                [(sym, multiplier, time_scale, start_ms, end_ms) for start_ms, end_ms, sym in sym_and_time_list],
+                pipeline.put_async,
+            )
+            pipeline.log_stats()
+        pipeline.close()
         print(f"[{datetime.datetime.now()}] ", freq, "done")
     if not args.live:
         _store_option_data_into_history(freq)
@@ -192,13 +412,14 @@ if __name__ == "__main__":
         universe_list = read_universe_list(args.universe)
     else:
         universe_list = args.symbol
+    scheduler = BarScheduler(LIVE_BASE_FREQUENCY, settle=DOWNLOAD_SETTLE)
     while True:
         # Update the bars (specific backtest code, as opposed to live trading)
         now = pd.Timestamp.now(tz=NY_TIMEZONE)
         time_since_midnight = now - now.normalize()
         if args.live and now.dayofweek > 4:
             if args.inst_type == "options":
-                for freq in ["5minute", "15minute", "day"]:
+                for freq in [LIVE_BASE_FREQUENCY] + LIVE_DERIVED_FREQUENCIES["options"]:
                     _store_option_data_into_history(freq)
             break
         # elif args.live and (
@@ -216,4 +437,5 @@ if __name__ == "__main__":
 
         if not args.live:
             break
-        time.sleep(600)
+        # wakes saturday 00:00 at the latest, so the weekend check above consolidates and exits
+        scheduler.sleep_until(min(scheduler.next_run(), end_of_trading_week(now, cutoff=datetime.timedelta(days=1))))
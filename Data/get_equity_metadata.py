@@ -1,11 +1,9 @@
 import argparse
-import os
 from pathlib import Path
-from sqlalchemy import create_engine
 
 import polars as pl
 
-from backtest.utilities.utils import get_db_engine, load_credentials, read_universe_list
+from backtest.utilities.utils import bulk_upsert, load_credentials, read_universe_list
 from Data.source.polygon import Polygon
 
 COLS_TO_SAVE = [
@@ -68,10 +66,5 @@ if __name__ == "__main__":
         ]
     )
 
-    eng = get_db_engine()
-    with eng.connect() as conn:
-        existing_df = pl.read_database("SELECT * from backtest.equity_metadata", conn)
-        stock_details_df = pl.concat([stock_details_df, existing_df]).unique(keep="first")
-        stock_details_df.write_database(
-            "backtest.equity_metadata", os.environ["DB_URL"], if_exists="append"
-        )
+    num_rows = bulk_upsert(stock_details_df, "backtest.equity_metadata", ["ticker"])
+    print(f"{num_rows} new rows in backtest.equity_metadata")
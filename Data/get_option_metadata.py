@@ -11,7 +11,7 @@ import pandas as pd
 from Data.source.polygon import Polygon
 from backtest.utilities.utils import (
     OPTION_METADATA_PATH,
-    get_db_engine,
+    bulk_upsert,
     get_ms_from_datetime,
     load_credentials,
     read_universe_list,
@@ -39,13 +39,36 @@ def get_source_instance(source):
     return importlib.import_module(f"Data.source.{source}").get_source_instance("options")
 
 def update_db(option_metadata_df: pd.DataFrame):
-    engine = get_db_engine()
-    with engine.connect() as conn:
-        existing_option_info_df = pd.read_sql("SELECT * FROM backtest.option_metadata", con=conn)
-        option_metadata_df = option_metadata_df.astype(existing_option_info_df.dtypes)
-        df = pd.concat([existing_option_info_df, option_metadata_df]).drop_duplicates(keep=False)
-        df.to_sql(con=conn, name='option_metadata', if_exists='append', index=False)
-    engine.dispose()
+    num_rows = bulk_upsert(option_metadata_df, "backtest.option_metadata", ["ticker"])
+    print(f"{num_rows} new rows in backtest.option_metadata")
+
+
+def get_new_option_metadata(getter: Polygon, option_metadata: OptionMetadata, universe_list, from_ms, to_ms, expired):
+    """
+    Fetches contracts of the whole universe in one concurrent batch and anti-joins them against the stored
+    metadata in a single pass. Returns only rows not stored yet, in METADATA_COL_TYPE column order.
+    """
+    res = getter.get_option_info_bulk(universe_list, from_ms, to_ms, expired)
+    res_df = pd.concat(
+        [pd.DataFrame(und_res).assign(underlying_sym=und) for und, und_res in res.items() if und_res]
+        + [pd.DataFrame(columns=list(METADATA_COL_TYPE.keys()))]
+    ).drop(["underlying_ticker", "additional_underlyings"], axis=1, errors="ignore")
+    no_result = [und for und, und_res in res.items() if not und_res]
+    if no_result:
+        print(f"No result for underlyings: {no_result}")
+    if res_df.empty:
+        return res_df
+    res_df["expiration_date"] = pd.to_datetime(res_df["expiration_date"])
+    res_df = res_df.loc[:, METADATA_COL_TYPE.keys()].astype(METADATA_COL_TYPE)
+
+    stored_df = option_metadata.get_option_metadata_for_symbols(universe_list)
+    stored_df = stored_df.reindex(columns=METADATA_COL_TYPE.keys()).replace("", np.nan).astype(METADATA_COL_TYPE)
+    new_info_df = (
+        res_df.merge(stored_df.drop_duplicates(), how="left", indicator=True)
+        .query("_merge == 'left_only'")
+        .drop("_merge", axis=1)
+    )
+    return new_info_df.sort_values(["underlying_sym", "expiration_date", "strike_price"]).loc[:, METADATA_COL_TYPE.keys()]
 
 
 DATA_FROM = datetime.datetime(2023, 9, 1)
@@ -82,49 +105,16 @@ if __name__ == "__main__":
             time.sleep(1600)
             continue
 
-        # option_metadata_df = option_metadata.loc[:, METADATA_COL_TYPE.keys()]
-        for underlying in universe_list:
-            # stored_df = pd.read_sql(f"SELECT * FROM backtest.option_metadata where underlying_sym='{underlying}'", con=get_db_engine().connect())
-            stored_df = option_metadata.get_option_metadata_for_symbol(underlying).loc[:, METADATA_COL_TYPE.keys()].astype(METADATA_COL_TYPE)
-            if "expiration_date" not in stored_df.columns:
-                print(f"expiration_date not in col and will cause error: {underlying}")
-                continue
-            from_ms = get_ms_from_datetime(datetime.datetime.now() - datetime.timedelta(days=1) if args.live else DATA_FROM)
-
-            if from_ms > to_ms:
-                print(f"info is updated. from_ms={from_ms} and to_ms={to_ms}")
-                continue
-            res = getter.get_option_info(underlying, from_ms, to_ms, not args.live)
-            res_df = pd.DataFrame(res).drop(["underlying_ticker", "additional_underlyings"], axis=1, errors="ignore")
-            if res_df.empty:
-                print(f"No result for underlying={underlying}")
-                continue
-            res_df["underlying_sym"] = underlying
-            res_df['expiration_date'] = pd.to_datetime(res_df['expiration_date'])
-            if "correction" not in res_df:
-                res_df["correction"] = np.nan
-            if not stored_df.empty:
-                stored_df = stored_df.replace('', np.nan).astype({'correction': 'float64'})
-                underlying_info_df = (
-                    res_df[METADATA_COL_TYPE.keys()].astype(METADATA_COL_TYPE)
-                    .merge(stored_df, how="left", indicator=True)
-                    .query("_merge == 'left_only'")
-                    .drop("_merge", axis=1)
-                )
-                underlying_info_df = underlying_info_df.sort_values(["expiration_date", "strike_price"]).loc[
-                    :, METADATA_COL_TYPE.keys()
-                ]
-            else:
-                underlying_info_df = res_df[METADATA_COL_TYPE.keys()]
-
-            # update_db(underlying_info_df)
-            try:
-                underlying_info_df.astype(METADATA_COL_TYPE).to_csv(
-                    OPTION_METADATA_PATH, mode="a", header=False, index=False
-                )
-            except KeyError:
-                print(f"KeyError when writing metadata for {underlying}")
-                continue
+        from_ms = get_ms_from_datetime(datetime.datetime.now() - datetime.timedelta(days=1) if args.live else DATA_FROM)
+        if from_ms > to_ms:
+            print(f"info is updated. from_ms={from_ms} and to_ms={to_ms}")
+        else:
+            new_info_df = get_new_option_metadata(getter, option_metadata, universe_list, from_ms, to_ms, not args.live)
+            print(f"{len(new_info_df)} new option metadata rows")
+            if not new_info_df.empty:
+                # update_db(new_info_df)
+                new_info_df.to_csv(OPTION_METADATA_PATH, mode="a", header=False, index=False)
+                option_metadata.invalidate()
         print(f"[{datetime.datetime.now()}] ", "done")
         if not args.live:
             break
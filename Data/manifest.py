@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Tuple
+
+import polars as pl
+
+
+class DownloadManifest:
+    """
+    Records which [from_ms, to_ms) ranges of each (inst_type, frequency, symbol) are already on disk,
+    so get_data only requests the gaps and a crashed run resumes where it stopped.
+    """
+
+    def __init__(self, db_fp=None) -> None:
+        db_fp = Path(os.environ["DATA_DIR"]) / "download_manifest.sqlite3" if db_fp is None else db_fp
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_fp, check_same_thread=False, timeout=60)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS downloaded_ranges (
+                inst_type TEXT NOT NULL,
+                frequency TEXT NOT NULL,
+                symbol TEXT NOT NULL,
+                from_ms INTEGER NOT NULL,
+                to_ms INTEGER NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS downloaded_ranges_key ON downloaded_ranges (inst_type, frequency, symbol)"
+        )
+        self.conn.commit()
+
+    def covered(self, inst_type: str, frequency: str, symbol: str) -> List[Tuple[int, int]]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT from_ms, to_ms FROM downloaded_ranges WHERE inst_type=? AND frequency=? AND symbol=? "
+                "ORDER BY from_ms",
+                (inst_type, frequency, symbol),
+            ).fetchall()
+        return rows
+
+    def missing(self, inst_type: str, frequency: str, symbol: str, from_ms: int, to_ms: int, pad_ms: int = 0):
+        """Gaps of [from_ms, to_ms) not covered yet. pad_ms re-requests a bit before each gap for late corrections"""
+        gaps = []
+        start = from_ms
+        for covered_from, covered_to in self.covered(inst_type, frequency, symbol):
+            if covered_to <= start:
+                continue
+            if covered_from >= to_ms:
+                break
+            if covered_from > start:
+                gaps.append((start, covered_from))
+            start = max(start, covered_to)
+        if start < to_ms:
+            gaps.append((start, to_ms))
+        return [(max(from_ms, gap_from - pad_ms), gap_to) for gap_from, gap_to in gaps]
+
+    def add(self, inst_type: str, frequency: str, symbol: str, from_ms: int, to_ms: int):
+        # merge with overlapping/adjacent ranges so each key stays a short list of disjoint ranges
+        key = (inst_type, frequency, symbol)
+        with self._lock:
+            overlapping = self.conn.execute(
+                "SELECT from_ms, to_ms FROM downloaded_ranges WHERE inst_type=? AND frequency=? AND symbol=? "
+                "AND from_ms <= ? AND to_ms >= ?",
+                (*key, to_ms, from_ms),
+            ).fetchall()
+            for covered_from, covered_to in overlapping:
+                from_ms, to_ms = min(from_ms, covered_from), max(to_ms, covered_to)
+            self.conn.execute(
+                "DELETE FROM downloaded_ranges WHERE inst_type=? AND frequency=? AND symbol=? "
+                "AND from_ms >= ? AND to_ms <= ?",
+                (*key, from_ms, to_ms),
+            )
+            self.conn.execute("INSERT INTO downloaded_ranges VALUES (?, ?, ?, ?, ?)", (*key, int(from_ms), int(to_ms)))
+            self.conn.commit()
+
+
+class WrittenContractIndex:
+    """
+    (frequency, contract) pairs whose bars are fully on disk, maintained by get_data and the option consolidator,
+    so finding contracts that still need downloading is a set difference instead of reading every written file.
+    """
+
+    def __init__(self, db_fp=None) -> None:
+        db_fp = Path(os.environ["DATA_DIR"]) / "download_manifest.sqlite3" if db_fp is None else db_fp
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_fp, check_same_thread=False, timeout=60)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS written_contracts (
+                frequency TEXT NOT NULL,
+                symbol TEXT NOT NULL,
+                PRIMARY KEY (frequency, symbol)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.commit()
+
+    def written(self, frequency: str) -> set:
+        with self._lock:
+            rows = self.conn.execute("SELECT symbol FROM written_contracts WHERE frequency=?", (frequency,)).fetchall()
+        return {row[0] for row in rows}
+
+    def add(self, frequency: str, symbols):
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO written_contracts VALUES (?, ?)", [(frequency, sym) for sym in symbols]
+            )
+            self.conn.commit()
+
+    def rebuild_from_consolidated(self, frequency: str):
+        # one-off backfill for data dirs consolidated before the index existed, including legacy {und}_options.csv
+        options_dir = Path(os.environ["DATA_DIR"]) / f"{frequency}/options"
+        frames = [pl.scan_parquet(fp).select("symbol") for fp in options_dir.glob("*/*.parquet")]
+        frames += [pl.scan_csv(fp).select("symbol") for fp in options_dir.glob("*_options.csv")]
+        if frames:
+            self.add(frequency, pl.concat(frames).unique().collect()["symbol"].to_list())
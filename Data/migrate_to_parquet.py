@@ -0,0 +1,41 @@
+import argparse
+import concurrent.futures as fut
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from Data.source.base.DataGetter import OHLC_COLUMNS, write_ohlc_parquet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="One-shot conversion of per-symbol ohlc csv files into the parquet store.")
+    parser.add_argument("--frequency", type=str, nargs="+", required=True, help="Frequency dirs to convert, eg 5minute day")
+    parser.add_argument("--inst-dir", type=str, nargs="+", default=["equity", "options_raw"], help="inst_type dirs to convert")
+    parser.add_argument("--delete-csv", action="store_true", default=False, help="remove csv once its parquet is written")
+    parser.add_argument("--num-workers", type=int, default=8)
+    return parser.parse_args()
+
+
+def _migrate_file(csv_fp: Path, delete_csv: bool):
+    # only strip the extension, tickers can have dots themselves (BRK.B)
+    symbol = csv_fp.name.removesuffix(".gz").removesuffix(".csv")
+    try:
+        df = pd.read_csv(csv_fp)
+        write_ohlc_parquet(csv_fp.parent / symbol, df.loc[:, ["timestamp"] + OHLC_COLUMNS])
+    except Exception as e:
+        print(f"Could not migrate {csv_fp}:\n{e}")
+        return
+    if delete_csv:
+        csv_fp.unlink()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    data_dir = Path(os.environ["DATA_DIR"])
+    for freq in args.frequency:
+        for inst_dir in args.inst_dir:
+            csv_fps = list((data_dir / freq / inst_dir).glob("*.csv")) + list((data_dir / freq / inst_dir).glob("*.csv.gz"))
+            print(f"{freq}/{inst_dir}: migrating {len(csv_fps)} files")
+            with fut.ProcessPoolExecutor(args.num_workers) as p:
+                list(p.map(_migrate_file, csv_fps, [args.delete_csv] * len(csv_fps)))
@@ -1,20 +1,89 @@
 import abc
+import datetime
+import logging
 import os
 from pathlib import Path
 from typing import List
 
 import pandas as pd
+import polars as pl
 
 from backtest.utilities.utils import DATA_GETTER_INST_TYPES
 
 _OHLC_COLUMNS_DEPRECATED = ['open', 'high', 'low', 'close', 'volume', 'vwap', 'num_trades']
 OHLC_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+OHLC_STORE_FORMATS = ["csv", "csv.gz", "parquet"]
+_OHLC_PL_SCHEMA = {"timestamp": pl.Int64, **{c: pl.Float64 for c in OHLC_COLUMNS}}
+
 
 def get_ohlc_fp(freq_prefix, freq, symbol, inst_type, compression="csv"):
-    assert compression in ["csv", "csv.gz"], "Only csv and csv.gz allowed"
+    # parquet is a directory per symbol holding one {year}.parquet partition per calendar year (UTC)
+    assert compression in OHLC_STORE_FORMATS, f"Only {OHLC_STORE_FORMATS} allowed"
     inst_dir_name = inst_type + ("_raw" if inst_type == "options" else "")
     freq_prefix = "" if freq == "day" else freq_prefix
-    return Path(os.getenv("DATA_DIR")) / f"{freq_prefix}{freq}" / inst_dir_name / f"{symbol}.{compression}"
+    inst_dir = Path(os.getenv("DATA_DIR")) / f"{freq_prefix}{freq}" / inst_dir_name
+    if compression == "parquet":
+        return inst_dir / symbol
+    return inst_dir / f"{symbol}.{compression}"
+
+
+def _year_from_ms(ms: int) -> int:
+    return datetime.datetime.fromtimestamp(ms / 1000, tz=datetime.timezone.utc).year
+
+
+def _pl_to_pandas(df: pl.DataFrame) -> pd.DataFrame:
+    # avoids polars' to_pandas, which needs pyarrow
+    return pd.DataFrame({c: df[c].to_numpy() for c in df.columns})
+
+
+def read_ohlc(fp: Path, from_ms=None, to_ms=None) -> pd.DataFrame:
+    """Reads bars in [from_ms, to_ms) from a csv file or a parquet symbol dir, with timestamp as a column"""
+    fp = Path(fp)
+    if fp.is_dir():
+        files = sorted(fp.glob("*.parquet"))
+        # partition pruning on the year in the filename, then row-group pushdown on timestamp
+        if from_ms is not None:
+            files = [f for f in files if int(f.stem) >= _year_from_ms(from_ms)]
+        if to_ms is not None:
+            files = [f for f in files if int(f.stem) <= _year_from_ms(to_ms)]
+        if not files:
+            return pd.DataFrame(columns=list(_OHLC_PL_SCHEMA.keys()))
+        lf = pl.scan_parquet(files)
+        if from_ms is not None:
+            lf = lf.filter(pl.col("timestamp") >= from_ms)
+        if to_ms is not None:
+            lf = lf.filter(pl.col("timestamp") < to_ms)
+        return _pl_to_pandas(lf.sort("timestamp").collect())
+    if not fp.exists():
+        return pd.DataFrame(columns=list(_OHLC_PL_SCHEMA.keys()))
+    df = pd.read_csv(fp)
+    if from_ms is not None:
+        df = df.loc[df.timestamp >= from_ms]
+    if to_ms is not None:
+        df = df.loc[df.timestamp < to_ms]
+    return df
+
+
+def write_ohlc_parquet(fp: Path, df: pd.DataFrame):
+    """Merges bars into the year partitions of a parquet symbol dir. Newer bars win on duplicate timestamps."""
+    if df.empty:
+        return
+    fp = Path(fp)
+    fp.mkdir(parents=True, exist_ok=True)
+    new_df = pl.DataFrame({c: df[c].to_numpy() for c in _OHLC_PL_SCHEMA.keys()}).cast(_OHLC_PL_SCHEMA)
+    new_df = new_df.with_columns(
+        pl.from_epoch("timestamp", time_unit="ms").dt.year().alias("_year")
+    )
+    for (year,), year_df in new_df.group_by("_year"):
+        part_fp = fp / f"{year}.parquet"
+        year_df = year_df.drop("_year")
+        if part_fp.exists():
+            year_df = pl.concat([pl.read_parquet(part_fp).cast(_OHLC_PL_SCHEMA), year_df])
+        year_df = year_df.unique(subset=["timestamp"], keep="last").sort("timestamp")
+        tmp_fp = part_fp.with_suffix(".tmp")
+        year_df.write_parquet(tmp_fp)
+        os.replace(tmp_fp, part_fp)
+
 
 class DataGetter(abc.ABC):
     def __init__(self, inst_type) -> None:
@@ -24,7 +93,7 @@ class DataGetter(abc.ABC):
         ), f"only inst_type from {DATA_GETTER_INST_TYPES} are allowed. inst_type={inst_type}"
         self.inst_type = inst_type
         self.write_cols = ["v", "vw", "o", "c", "h", "l", "n"]  # 't' in get_ohlc result as well
-        self._data_getter_options = ["csv", "gz", "proto"]
+        self._data_getter_options = ["csv", "gz", "parquet"]
 
     def get_all_methods(self):
         return list(object.__dict__.keys())
@@ -38,9 +107,8 @@ class DataGetter(abc.ABC):
         assert compression in self._data_getter_options, f"compression has to be one of {self._data_getter_options}"
 
         df = self.get_ohlc(symbol, multiplier, freq, from_ms, to_ms)
-        if compression == "proto":
-            # TODO: Implement
-            pass
+        if compression == "parquet":
+            write_ohlc_parquet(fp, df)
         else:
             if df.empty:
                 return
@@ -0,0 +1,56 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """asyncio token bucket: refills at rate tokens/s up to capacity, acquire() waits for a token"""
+
+    def __init__(self, rate: float, capacity=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def get_json_with_retry(
+    session: aiohttp.ClientSession,
+    url: str,
+    bucket: TokenBucket,
+    params=None,
+    max_retries: int = 5,
+    base_delay: float = 1.0,
+) -> dict:
+    # full-jitter exponential backoff on 429/5xx and connection errors, honouring Retry-After when sent
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        delay = random.uniform(0, base_delay * 2**attempt)
+        try:
+            async with session.get(url, params=params) as resp:
+                if resp.status not in RETRY_STATUS:
+                    resp.raise_for_status()
+                    return await resp.json()
+                if "Retry-After" in resp.headers:
+                    delay = max(delay, float(resp.headers["Retry-After"]))
+                err = Exception(f"status={resp.status}, url={url}")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            err = e
+        if attempt == max_retries:
+            raise err
+        await asyncio.sleep(delay)
@@ -1,12 +1,29 @@
+import asyncio
 import logging
 import os
-from typing import List
+from typing import Callable, List
 import requests
 
+import aiohttp
 import pandas as pd
 from polygon import RESTClient
 
 from Data.source.base.DataGetter import DataGetter
+from Data.source.base.rate_limit import TokenBucket, get_json_with_retry
+
+# requests/s allowed by our polygon tier, and max requests in flight
+POLYGON_RATE_PER_SEC = 90
+POLYGON_MAX_CONCURRENCY = 32
+_AGGS_COLUMNS = {
+    "o": "open",
+    "h": "high",
+    "l": "low",
+    "c": "close",
+    "v": "volume",
+    "vw": "vwap",
+    "t": "timestamp",
+    "n": "num_trades",
+}
 
 
 class Polygon(DataGetter):
@@ -15,7 +32,7 @@ class Polygon(DataGetter):
         self._api_key = os.environ["POLYGON_API"]
         self.client = RESTClient(self._api_key)
         self.BASE_URL = "https://api.polygon.io/"
-        self._data_getter_options = ["csv", "gz", "proto"]
+        self._data_getter_options = ["csv", "gz", "parquet"]
         self._80_days_in_ms = 6912000000
         self._limit_count = 49500
 
@@ -67,6 +84,74 @@ class Polygon(DataGetter):
             results.drop("otc", axis=1, inplace=True)
         return results
 
+    async def _get_ohlc_async(self, session, bucket, symbol, multiplier, freq, from_ms, to_ms) -> pd.DataFrame:
+        url = self.BASE_URL + f"v2/aggs/ticker/{symbol}/range/{multiplier}/{freq}/{from_ms}/{to_ms}"
+        params = dict(adjusted="true", sort="asc", limit=50000, apiKey=self._api_key)
+        results = []
+        while url is not None:
+            resp_json = await get_json_with_retry(session, url, bucket, params=params)
+            results.extend(resp_json.get("results", []))
+            # next_url already carries the query and cursor, only the key has to be re-added
+            url = resp_json.get("next_url")
+            params = dict(apiKey=self._api_key)
+        results = pd.DataFrame(results)
+        if not results.empty:
+            results = results.rename(_AGGS_COLUMNS, axis=1)
+            results = results.loc[:, [c for c in _AGGS_COLUMNS.values() if c in results]]
+        return results
+
+    async def _stream_ohlc(self, requests_list, on_result, rate_per_sec, max_concurrency):
+        bucket = TokenBucket(rate_per_sec)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        connector = aiohttp.TCPConnector(limit=max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=120)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def _fetch(request):
+                symbol, multiplier, freq, from_ms, to_ms = request
+                async with semaphore:
+                    try:
+                        df = await self._get_ohlc_async(session, bucket, symbol, multiplier, freq, from_ms, to_ms)
+                    except Exception as e:
+                        logging.error(f"Failed to get ohlc: request={request}, e={e}")
+                        return
+                if asyncio.iscoroutinefunction(on_result):
+                    await on_result(request, df)
+                else:
+                    on_result(request, df)
+
+            def _log_failures(requests, results):
+                # on_result errors end up on the task, which nothing else awaits
+                for request, result in zip(requests, results):
+                    if isinstance(result, BaseException):
+                        logging.error(f"Failed to handle ohlc result: request={request}, e={result!r}")
+
+            # requests are scheduled lazily so pending coroutines stay bounded by max_concurrency
+            pending = {}
+            for request in requests_list:
+                if len(pending) >= max_concurrency:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    _log_failures([pending.pop(task) for task in done], [task.exception() for task in done])
+                pending[asyncio.ensure_future(_fetch(request))] = request
+            if pending:
+                _log_failures(pending.values(), await asyncio.gather(*pending, return_exceptions=True))
+
+    def stream_ohlc(
+        self,
+        requests_list,
+        on_result: Callable,
+        rate_per_sec=POLYGON_RATE_PER_SEC,
+        max_concurrency=POLYGON_MAX_CONCURRENCY,
+    ):
+        """
+        Fetches aggregates for (symbol, multiplier, freq, from_ms, to_ms) requests concurrently under a token
+        bucket rate limit, and hands each result to on_result(request, df) as soon as it completes so
+        nothing is held in memory waiting for the whole batch. on_result may be a coroutine function, which
+        lets it apply back-pressure to its fetch. Failed requests are logged and skipped.
+        """
+        asyncio.run(self._stream_ohlc(requests_list, on_result, rate_per_sec, max_concurrency))
+
     def get_option_info(self, underlying_symbol, from_ms, to_ms, expired: bool = True):
         def _chop_finer_dates(from_ms, to_ms) -> List[tuple]:
             tuple_ms = []
@@ -95,6 +180,57 @@ class Polygon(DataGetter):
             results.extend(resp_json["results"])
         return results
     
+    async def _get_option_info_async(self, session, bucket, underlying_symbol, from_ms, to_ms, expired) -> list:
+        url = self.BASE_URL + "v3/reference/options/contracts"
+        params = {
+            "underlying_ticker": underlying_symbol,
+            "limit": 1000,
+            "expired": str(expired).lower(),
+            "expiration_date.gte": pd.Timestamp(from_ms, unit="ms").strftime("%Y-%m-%d"),
+            "expiration_date.lt": pd.Timestamp(to_ms, unit="ms").strftime("%Y-%m-%d"),
+            "apiKey": self._api_key,
+        }
+        results = []
+        while url is not None:
+            resp_json = await get_json_with_retry(session, url, bucket, params=params)
+            results.extend(resp_json.get("results", []))
+            url = resp_json.get("next_url")
+            params = dict(apiKey=self._api_key)
+        return results
+
+    async def _get_option_info_bulk(self, underlying_list, from_ms, to_ms, expired, rate_per_sec, max_concurrency):
+        bucket = TokenBucket(rate_per_sec)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        connector = aiohttp.TCPConnector(limit=max_concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+
+            async def _fetch(underlying_symbol):
+                async with semaphore:
+                    try:
+                        return await self._get_option_info_async(
+                            session, bucket, underlying_symbol, from_ms, to_ms, expired
+                        )
+                    except Exception as e:
+                        logging.error(f"Failed to get option info: underlying={underlying_symbol}, e={e}")
+                        return []
+
+            results = await asyncio.gather(*[_fetch(und) for und in underlying_list])
+        return dict(zip(underlying_list, results))
+
+    def get_option_info_bulk(
+        self,
+        underlying_list,
+        from_ms,
+        to_ms,
+        expired: bool = True,
+        rate_per_sec=POLYGON_RATE_PER_SEC,
+        max_concurrency=POLYGON_MAX_CONCURRENCY,
+    ) -> dict:
+        """Option contracts of every underlying, fetched concurrently with cursor pagination. Maps underlying to results"""
+        return asyncio.run(
+            self._get_option_info_bulk(underlying_list, from_ms, to_ms, expired, rate_per_sec, max_concurrency)
+        )
+
     def get_stock_details(self, symbol):
         url = (
             self.BASE_URL
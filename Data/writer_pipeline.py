@@ -0,0 +1,75 @@
+import asyncio
+import queue
+import threading
+import time
+import zlib
+from typing import Callable
+
+
+class WriterPipeline:
+    """
+    Bounded producer/consumer hand-off between fetchers and disk writers.
+    Results are routed to a writer by symbol so writes to the same file never run concurrently, and
+    put blocks once a writer's queue is full so peak memory is set by max_queue and not by batch size.
+    """
+
+    def __init__(self, write_fn: Callable, num_writers: int = 4, max_queue: int = 256, name: str = "") -> None:
+        self.write_fn = write_fn
+        self.name = name
+        self._queues = [queue.Queue(max(max_queue // num_writers, 1)) for _ in range(num_writers)]
+        self._writers = [threading.Thread(target=self._write_loop, args=(q,), daemon=True) for q in self._queues]
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self.num_put = 0
+        self.num_written = 0
+        self.num_failed = 0
+        self.max_depth = 0
+        self.blocked_s = 0.0
+        for writer in self._writers:
+            writer.start()
+
+    def _write_loop(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                self.write_fn(*item)
+            except Exception as e:
+                print(f"[{self.name}] write failed for {item[0]}: {e}")
+                with self._lock:
+                    self.num_failed += 1
+            else:
+                with self._lock:
+                    self.num_written += 1
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def put(self, request, df):
+        q = self._queues[zlib.crc32(str(request[0]).encode()) % len(self._queues)]
+        start = time.time()
+        q.put((request, df))
+        with self._lock:
+            self.blocked_s += time.time() - start
+            self.num_put += 1
+            self.max_depth = max(self.max_depth, self.depth())
+
+    async def put_async(self, request, df):
+        # blocks only this fetch coroutine while the writers catch up, not the event loop
+        await asyncio.to_thread(self.put, request, df)
+
+    def close(self):
+        for q in self._queues:
+            q.put(None)
+        for writer in self._writers:
+            writer.join()
+        self.log_stats()
+
+    def log_stats(self):
+        elapsed = max(time.time() - self._start, 1e-9)
+        print(
+            f"[{self.name}] fetched={self.num_put} ({self.num_put / elapsed:.1f}/s) "
+            f"written={self.num_written} ({self.num_written / elapsed:.1f}/s) failed={self.num_failed} "
+            f"depth={self.depth()} max_depth={self.max_depth} fetch_blocked={self.blocked_s:.1f}s"
+        )
@@ -10,8 +10,15 @@ from trading.portfolio.rebalance import NoRebalance, RebalanceMonthly
 from trading.strategy.complex.correlation import PairTrading, InvPairTrading
 from trading.utilities.enum import OrderType
 
+# kwargs of get_config searched by `loop.py --optimize`
+PARAM_SPACE = {
+    "lookback": [50, 100, 200],
+    "price_margin_perc": [1e-6, 1e-5, 1e-4],
+    "sd_deviation": [2, 2.5, 3],
+}
 
-def get_config() -> dict:
+
+def get_config(lookback=100, price_margin_perc=1e-6, sd_deviation=3) -> dict:
     d = {
         # MANDATORY
         "credentials_fp": Path(os.environ["WORKSPACE_ROOT"]) / "real_credentials.json",
@@ -27,8 +34,8 @@ def get_config() -> dict:
         # OPTIONAL
     }
     strategy = InvPairTrading(
-        100, pairs=[("QQQ", "QID"), ("IWM", "RWM")], price_margin_perc=1e-6,
-        min_update_freq=timedelta(minutes=2), sd_deviation=3
+        lookback, pairs=[("QQQ", "QID"), ("IWM", "RWM")], price_margin_perc=price_margin_perc,
+        min_update_freq=timedelta(minutes=2), sd_deviation=sd_deviation
     )
 
     # eng = create_engine(os.environ["DB_URL"])
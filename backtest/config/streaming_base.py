@@ -2,8 +2,7 @@ from datetime import timedelta
 import os
 from pathlib import Path
 
-import pandas as pd
-
+from backtest.utilities.warmup import warmup_strategy
 from trading.portfolio.portfolio import FixedTradeValuePortfolio
 from trading.portfolio.rebalance import NoRebalance, RebalanceMonthly
 from trading.strategy.complex.correlation import PairTrading, InvPairTrading
@@ -27,16 +26,17 @@ def get_config() -> dict:
         # OPTIONAL
     }
 
-    strategy = PairTrading(30, pairs=[("SPY", "VOO"), ("QQQ", "QQQM")], price_margin_perc=1e-5,
-                           min_update_freq=timedelta(minutes=2), sd_deviation=2)
-    eng = get_db_engine()
-    df_warmup = pd.read_sql("""
-        SELECT * FROM ibkr.market_data_bars_uniq
-        WHERE frequency = '15 mins'
-            and to_timestamp(timestamp / 1000) > date('2024-06-01')
-        order by timestamp;
-    """, eng)
-    strategy.warmup(df_warmup)
+    pairs = [("SPY", "VOO"), ("QQQ", "QQQM")]
+    lookback = 30
+    strategy_params = dict(pairs=pairs, price_margin_perc=1e-5, min_update_freq=timedelta(minutes=2), sd_deviation=2)
+    strategy = warmup_strategy(
+        PairTrading(lookback, **strategy_params),
+        symbols=[sym for pair in pairs for sym in pair],
+        frequency="15 mins",
+        lookback=timedelta(days=180),
+        snapshot_name=d["name"],
+        params=dict(lookback=lookback, **strategy_params),
+    )
     print(len(strategy.pairs_info["VOO"].past_ratios), strategy.pairs_info["VOO"].p1_update_time)
 
     port = FixedTradeValuePortfolio(
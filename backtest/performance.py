@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 import pandas as pd
 
@@ -10,24 +12,161 @@ def create_sharpe_ratio(returns, periods=252):
     return np.sqrt(periods) * (np.mean(returns)) / np.std(returns)
 
 
+def _drawdown_arrays(values: np.ndarray):
+    """
+    Running high-water mark, drawdown and drawdown duration of an equity array.
+    Like the original loop, the hwm starts at 0 and the first period is left as NaN.
+    """
+    n = len(values)
+    drawdown = np.full(n, np.nan)
+    duration = np.full(n, np.nan)
+    if n < 2:
+        return drawdown, duration
+    hwm = np.maximum.accumulate(np.maximum(values[1:], 0))
+    drawdown[1:] = hwm - values[1:]
+
+    # bars since the last period the hwm was touched (run-length of non-zero drawdowns)
+    idx = np.arange(n)
+    in_dd = np.zeros(n, dtype=bool)
+    in_dd[1:] = drawdown[1:] != 0
+    last_reset = np.maximum.accumulate(np.where(in_dd, 0, idx))
+    duration[1:] = (idx - last_reset)[1:]
+    return drawdown, duration
+
+
 def create_drawdowns(equity_curve):
     """
     provides both the maximum drawdown and the maximum drawdown duration.
-    The former is the aforementioned largest peak-to-trough drop, 
+    The former is the aforementioned largest peak-to-trough drop,
     latter is defined as the number of periods over which this drop occurs.
 
     Args:
     erquity_curve - pandas series representing period % returns
     """
-    hwm = [0]
+    drawdown, duration = _drawdown_arrays(np.asarray(equity_curve, dtype="float64"))
+    return pd.Series(drawdown).max(), pd.Series(duration).max()
+
+
+def create_drawdown_details(equity_curve: pd.Series, top_n: int = 5):
+    """
+    Full drawdown breakdown of an equity curve.
+
+    Returns:
+    drawdown - pandas series of hwm - equity, indexed like equity_curve
+    duration - pandas series of periods since the last hwm
+    episodes - dataframe of the top_n deepest drawdowns with peak/trough/recovery
+               timestamps (recovery is NaT if the curve has not recovered yet)
+    """
     eq_idx = equity_curve.index
-    drawdown = pd.Series(index=eq_idx, dtype='float64')
-    duration = pd.Series(index=eq_idx, dtype='float64')
+    drawdown, duration = _drawdown_arrays(np.asarray(equity_curve, dtype="float64"))
+    episode_cols = ["peak", "trough", "recovery", "max_drawdown", "duration"]
+
+    in_dd = np.nan_to_num(drawdown) > 0
+    edges = np.diff(np.concatenate(([0], in_dd.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)  # exclusive
+    if len(starts) == 0:
+        episodes = pd.DataFrame(columns=episode_cols)
+    else:
+        depths = np.maximum.reduceat(np.nan_to_num(drawdown), starts)
+        top = np.argsort(-depths, kind="stable")[:top_n]
+        rows = []
+        for i in top:
+            start, end = starts[i], ends[i]
+            trough = start + np.argmax(drawdown[start:end])
+            rows.append(
+                dict(
+                    peak=eq_idx[start - 1],
+                    trough=eq_idx[trough],
+                    recovery=eq_idx[end] if end < len(eq_idx) else pd.NaT,
+                    max_drawdown=depths[i],
+                    duration=end - start,
+                )
+            )
+        episodes = pd.DataFrame(rows, columns=episode_cols)
+
+    return pd.Series(drawdown, index=eq_idx), pd.Series(duration, index=eq_idx), episodes
+
+
+def gross_exposure(holdings: dict) -> float:
+    """
+    Sum of abs(position market value) over the instruments in portfolio.current_holdings, so longs and shorts
+    add up instead of netting out. Entries without a position (total, cash, commission) are skipped.
+    """
+    gross = 0.0
+    for inst in holdings.values():
+        net_pos = getattr(inst, "net_pos", None)
+        if net_pos:
+            gross += abs(net_pos * (inst.latest_ref_price or 0.0))
+    return gross
+
+
+class RunningPerformance:
+    """
+    O(1)-per-update performance metrics, readable at any time without building an equity curve df.
+    Sharpe uses Welford's online mean/variance over period returns. Multiple updates with the same
+    timestamp (one per symbol MARKET event) are folded into a single period.
+    """
+
+    def __init__(self, periods=252) -> None:
+        self.periods = periods
+        self.num_periods = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.hwm = 0.0
+        self.max_drawdown = 0.0
+        self.duration = 0
+        self.max_duration = 0
+        self.traded_value = 0.0
+        self._exposure_sum = 0.0
+        self._equity_sum = 0.0
+        self._last_equity = None
+        # latest sample of the period that is still open
+        self._pending_ts = None
+        self._pending = None
+
+    def update(self, timestamp, equity: float, gross_exposure: float = 0.0):
+        if self._pending_ts is not None and timestamp != self._pending_ts:
+            self._commit(*self._pending)
+        self._pending_ts = timestamp
+        self._pending = (equity, gross_exposure)
+
+    def update_fill(self, traded_value: float):
+        self.traded_value += abs(traded_value)
 
-    for t in range(1, len(eq_idx)):
-        cur_hwm = max(hwm[t-1], equity_curve.iloc[t])
-        hwm.append(cur_hwm)
-        drawdown.iloc[t] = hwm[t] - equity_curve.iloc[t]
-        duration.iloc[t] = 0 if drawdown.iloc[t] == 0 else duration.iloc[t-1] + 1
+    def _commit(self, equity, gross_exposure):
+        if self._last_equity:
+            ret = equity / self._last_equity - 1
+            self.num_periods += 1
+            delta = ret - self._mean
+            self._mean += delta / self.num_periods
+            self._m2 += delta * (ret - self._mean)
+        self._last_equity = equity
+        self.hwm = max(self.hwm, equity)
+        drawdown = self.hwm - equity
+        self.duration = 0 if drawdown == 0 else self.duration + 1
+        self.max_drawdown = max(self.max_drawdown, drawdown)
+        self.max_duration = max(self.max_duration, self.duration)
+        if equity:
+            self._exposure_sum += abs(gross_exposure) / equity
+        self._equity_sum += equity
 
-    return drawdown.max(), duration.max()
+    def summary(self) -> dict:
+        # fold the open period into a copy so reads never mutate the accumulator
+        stats = self
+        if self._pending is not None:
+            stats = copy.copy(self)
+            stats._pending_ts, stats._pending = None, None
+            stats._commit(*self._pending)
+        num_bars = stats.num_periods + (stats._last_equity is not None)
+        std = np.sqrt(stats._m2 / stats.num_periods) if stats.num_periods else 0.0
+        return {
+            "equity": stats._last_equity,
+            "sharpe": np.sqrt(self.periods) * stats._mean / std if std else np.nan,
+            "max_drawdown": stats.max_drawdown,
+            "drawdown": stats.hwm - stats._last_equity if num_bars else 0.0,
+            "drawdown_duration": stats.duration,
+            "max_drawdown_duration": stats.max_duration,
+            "turnover": stats.traded_value / (stats._equity_sum / num_bars) if stats._equity_sum else 0.0,
+            "exposure": stats._exposure_sum / num_bars if num_bars else 0.0,
+        }
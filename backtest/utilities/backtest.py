@@ -1,12 +1,20 @@
 from collections import deque
 import datetime
+import logging
+import os
 import time
 import queue
+from pathlib import Path
 
 import pandas as pd
 
-from trading.broker.broker import Broker
+from backtest.performance import RunningPerformance, gross_exposure
+from backtest.utilities.events import EventType, MarketBatchEvent, OrderQueue, bars_panel
+from backtest.utilities.journal import JOURNAL_LEVELS, EventJournal
+from trading.broker.broker import Broker, SimulatedBroker
 from trading.portfolio.portfolio import Portfolio
+from backtest.utilities.profiler import EventLoopProfiler
+from backtest.utilities.scheduler import BarScheduler, end_of_trading_week
 from backtest.utilities.utils import log_message
 from trading.strategy.base import Strategy
 from trading.data.dataHandler import DataHandler
@@ -21,9 +29,48 @@ class Backtest:
         self.portfolio: Portfolio = args.portfolio
         self.broker: Broker = args.broker
         self.event_queue = deque([])
-        self.order_queue = queue.Queue()
+        # only the simulated broker fills on this thread, every other broker (IBBroker, also when a streaming loop
+        # runs it with live=False) puts fills from its own threads and needs the thread-safe queue
+        self.order_queue = OrderQueue() if isinstance(self.broker, SimulatedBroker) else queue.Queue()
+        self.metrics = RunningPerformance(periods=getattr(args, "sharpe_periods", 252))
 
-        self.show_plot = args.num_runs == 1
+        single_run = args.num_runs == 1 and getattr(args, "optimize", None) is None
+        self.show_plot = single_run
+        # stop after max_bars updates, used by optimize to score candidates on a partial run
+        self.max_bars = getattr(args, "max_bars", None)
+        self.name = getattr(args, "name", "")
+        # sweep and optimize runs each get their own trade log and profile file, tagged with run_tag
+        run_tag = getattr(args, "run_tag", None)
+        self.file_prefix = f"{self.name}_{run_tag}" if run_tag is not None else self.name
+        # backtests only profile with --profile-sample-every, live runs always time every stage (see run)
+        sample_every = getattr(args, "profile_sample_every", 0)
+        self.profiler = EventLoopProfiler(sample_every=sample_every, enabled=sample_every > 0)
+        # live bars whose handling takes longer than this get their per-stage breakdown logged
+        self.slow_bar_ms = getattr(args, "slow_bar_ms", 500)
+        settle_seconds = getattr(args, "settle_seconds", None)
+        self.scheduler = BarScheduler(
+            getattr(args, "frequency", "5minute"),
+            settle=datetime.timedelta(seconds=5 if settle_seconds is None else settle_seconds),
+        )
+        # one trade log per run
+        journal_fmt = getattr(args, "journal_format", "jsonl")
+        journal_fp = Path(os.environ["DATA_DIR"]) / f"logging/{self.file_prefix}_trades.{journal_fmt}"
+        self.journal = EventJournal(
+            journal_fp if self.name else None,
+            level=JOURNAL_LEVELS[getattr(args, "journal_level", "INFO")],
+            fmt=journal_fmt,
+        )
+        self._journal_bars = self.journal.level <= logging.DEBUG
+        self._bar_timestamp = None
+        # strategies implementing calculate_signals_batch(timestamp, bars_panel) get each timestamp's bars at once
+        self._batch_signals = callable(getattr(self.strategy, "calculate_signals_batch", None))
+        self._handlers = {
+            EventType.MARKET: self._on_market,
+            EventType.MARKET_BATCH: self._on_market_batch,
+            EventType.SIGNAL: self._on_signal,
+            EventType.ORDER: self._on_order,
+            EventType.FILL: self._on_fill,
+        }
 
         # self.portfolio.Initialize(
         #     self.data_provider.symbol_list,
@@ -34,16 +81,25 @@ class Backtest:
     def run(self, live: bool):
         # core backtest logic
         if live:
+            # live bars are few and far between, time every stage so a slow bar is always attributed
+            self.profiler = EventLoopProfiler(sample_every=1)
             self._life_loop()
         else:
             plotter = self._backtest_loop()
 
     def _backtest_loop(self):
         start = time.time()
+        num_bars = 0
         while True:
             # Update the bars (specific backtest code, as opposed to live trading)
-            if self.data_provider.continue_backtest == True:
+            if self.data_provider.continue_backtest == True and (self.max_bars is None or num_bars < self.max_bars):
+                self.profiler.next_event()
+                t0 = self.profiler.start()
                 self.data_provider.update_bars(self.event_queue)
+                self.profiler.stop("update_bars", None, t0)
+                num_bars += 1
+                if self._batch_signals:
+                    self._coalesce_market_events()
             else:
                 while len(self.event_queue) > 0:
                     self.event_queue.pop()
@@ -51,6 +107,9 @@ class Backtest:
             self._handle_event()
 
         print(f"Backtest finished in {time.time() - start}. Getting summary stats")
+        print(f"Running stats: {self.metrics.summary()}")
+        self._dump_profile()
+        self.journal.close()
         self.portfolio.create_equity_curve_df()
         log_message(self.portfolio.output_summary_stats())
         print(self.portfolio.output_summary_stats())
@@ -60,49 +119,146 @@ class Backtest:
 
     def _life_loop(self) -> None:
         while True:
-            # Update the bars (specific backtest code, as opposed to live trading)
+            # sleep to the next bar close of an open session, stop for the week once that is past friday evening
             now = pd.Timestamp.now(tz=NY_TIMEZONE)
-            if (now.dayofweek == 4 and now.hour > 17) or now.dayofweek > 4:
+            if not self.scheduler.wait_for_next_bar(stop_at=end_of_trading_week(now)):
                 break
-            # only run during trading hours -> 0945 - 1745
-            time_since_midnight = now - now.normalize()
-            if time_since_midnight < datetime.timedelta(
-                hours=9, minutes=45
-            ) or time_since_midnight > datetime.timedelta(hours=17, minutes=45):
-                continue
+            self.profiler.reset_bar()
+            self.profiler.next_event()
+            bar_start = time.perf_counter()
+            t0 = self.profiler.start()
             self.data_provider.update_bars(self.event_queue, live=True)
+            self.profiler.stop("update_bars", None, t0)
+            if self._batch_signals:
+                self._coalesce_market_events()
             self._handle_event()
+            bar_ms = (time.perf_counter() - bar_start) * 1e3
+            log_message(f"Running stats: {self.metrics.summary()}")
+            if bar_ms > self.slow_bar_ms:
+                breakdown = {stage: round(ns / 1e6, 3) for stage, ns in self.profiler.bar_breakdown.items()}
+                log_message(f"Slow bar: {bar_ms:.1f}ms, stage ms: {breakdown}")
 
             self.portfolio.write_curr_holdings()
     
+    def _dump_profile(self):
+        if not self.profiler.enabled:
+            return
+        print(f"Event loop profile: {self.profiler.summary()}")
+        if self.name:
+            self.profiler.dump_json(Path(os.environ["DATA_DIR"]) / f"logging/{self.file_prefix}_profile.json")
+
+    def _update_metrics(self, market_bar):
+        holdings = self.portfolio.current_holdings
+        self.metrics.update(market_bar["timestamp"], holdings["total"], gross_exposure(holdings))
+
     def _handle_event(self):
-        while True:
-            try:
-                event = self.event_queue.pop()
-            except IndexError:
-                break
-            else:
-                if event is not None:
-                    if event.type == "MARKET":
-                        market_bar = event.data
-                        if (
-                            self.portfolio.update_option_datetime(market_bar, self.event_queue) and
-                            self.portfolio.update_timeindex(market_bar, self.event_queue)
-                        ):
-                            inst = self.portfolio.current_holdings[event.symbol]
-                            signal_list = self.strategy.calculate_signals(
-                                event, inst=inst)
-                            for signal in signal_list:
-                                self.event_queue.appendleft(signal)
-                            while not self.order_queue.empty():
-                                self.event_queue.append(self.order_queue.get())
-                    elif event.type == "SIGNAL":
-                        self.portfolio.update_signal(event, self.event_queue)  # sends OrderEvent
-
-                    elif event.type == "ORDER":
-                        if self.broker.execute_order(event, self.event_queue, self.order_queue):
-                            log_message(event.details())
-
-                    elif event.type == "FILL":
-                        print("[FILLED]\t", event.order_event.details())
-                        self.portfolio.update_fill(event, False)
+        event_queue, handlers, profiler = self.event_queue, self._handlers, self.profiler
+        while event_queue:
+            event = event_queue.pop()
+            if event is None:
+                continue
+            handler = handlers.get(event.type)
+            if handler is not None:
+                profiler.next_event()
+                handler(event)
+
+    def _on_market(self, event):
+        profiler = self.profiler
+        market_bar = event.data
+        self._bar_timestamp = market_bar["timestamp"]
+        if self._journal_bars:
+            self.journal.debug("bar", bar_ts=self._bar_timestamp, symbol=event.symbol)
+        t0 = profiler.start()
+        option_dt_updated = self.portfolio.update_option_datetime(market_bar, self.event_queue)
+        profiler.stop("update_option_datetime", event.symbol, t0)
+        if not option_dt_updated:
+            return
+        t0 = profiler.start()
+        timeindex_updated = self.portfolio.update_timeindex(market_bar, self.event_queue)
+        profiler.stop("update_timeindex", event.symbol, t0)
+        if not timeindex_updated:
+            return
+        self._update_metrics(market_bar)
+        self._calculate_signals(event)
+
+    def _coalesce_market_events(self):
+        # groups the MarketEvents of per-bar data handlers by timestamp, so batch strategies see the cross-section
+        if not self.event_queue or any(e is None or e.type != EventType.MARKET for e in self.event_queue):
+            return
+        by_timestamp = {}
+        for market_event in self.event_queue:
+            by_timestamp.setdefault(market_event.data["timestamp"], []).append(market_event)
+        self.event_queue.clear()
+        # popped from the right, so the earliest timestamp goes last
+        for timestamp in sorted(by_timestamp, reverse=True):
+            self.event_queue.append(MarketBatchEvent(timestamp, by_timestamp[timestamp]))
+
+    def _on_market_batch(self, event):
+        profiler = self.profiler
+        self._bar_timestamp = event.timestamp
+        if self._journal_bars:
+            self.journal.debug("bar", bar_ts=event.timestamp, symbol=[e.symbol for e in event.events])
+        t0 = profiler.start()
+        market_events = [e for e in event.events if self.portfolio.update_option_datetime(e.data, self.event_queue)]
+        profiler.stop("update_option_datetime", None, t0)
+        if not market_events:
+            return
+        # portfolios without a batch time index update take the bars one at a time
+        update_timeindex_batch = getattr(self.portfolio, "update_timeindex_batch", None)
+        t0 = profiler.start()
+        if update_timeindex_batch is not None:
+            if not update_timeindex_batch(event.timestamp, [e.data for e in market_events], self.event_queue):
+                market_events = []
+        else:
+            market_events = [e for e in market_events if self.portfolio.update_timeindex(e.data, self.event_queue)]
+        profiler.stop("update_timeindex", None, t0)
+        if not market_events:
+            return
+        self._update_metrics(market_events[-1].data)
+        if not self._batch_signals:
+            for market_event in market_events:
+                self._calculate_signals(market_event)
+            return
+        panel = bars_panel(market_events, event.bars if len(market_events) == len(event.events) else None)
+        panel["inst"] = [self.portfolio.current_holdings[e.symbol] for e in market_events]
+        t0 = profiler.start()
+        signal_list = self.strategy.calculate_signals_batch(event.timestamp, panel)
+        profiler.stop("calculate_signals", None, t0)
+        self._queue_signals(signal_list)
+
+    def _calculate_signals(self, event):
+        inst = self.portfolio.current_holdings[event.symbol]
+        t0 = self.profiler.start()
+        signal_list = self.strategy.calculate_signals(event, inst=inst)
+        self.profiler.stop("calculate_signals", event.symbol, t0)
+        self._queue_signals(signal_list)
+
+    def _queue_signals(self, signal_list):
+        self.event_queue.extendleft(signal_list)
+        while not self.order_queue.empty():
+            self.event_queue.append(self.order_queue.get())
+
+    def _on_signal(self, event):
+        t0 = self.profiler.start()
+        self.portfolio.update_signal(event, self.event_queue)  # sends OrderEvent
+        self.profiler.stop("update_signal", event.symbol, t0)
+
+    def _on_order(self, event):
+        t0 = self.profiler.start()
+        executed = self.broker.execute_order(event, self.event_queue, self.order_queue)
+        self.profiler.stop("execute_order", event.symbol, t0)
+        if executed:
+            self.journal.info(
+                "order", bar_ts=self._bar_timestamp, symbol=event.symbol, quantity=event.quantity,
+                price=event.trade_price,
+            )
+
+    def _on_fill(self, event):
+        order = event.order_event
+        t0 = self.profiler.start()
+        self.portfolio.update_fill(event, False)
+        self.profiler.stop("update_fill", order.symbol, t0)
+        self.metrics.update_fill(order.quantity * order.trade_price)
+        self.journal.info(
+            "fill", bar_ts=self._bar_timestamp, symbol=order.symbol, quantity=order.quantity, price=order.trade_price
+        )
@@ -0,0 +1,128 @@
+import heapq
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import pandas as pd
+
+from Data.source.base.DataGetter import get_ohlc_fp, read_ohlc
+from backtest.utilities.events import MarketBatchEvent, MarketEvent
+from backtest.utilities.resample import parse_frequency, resample_bars
+
+
+def merge_bar_streams(streams: Dict[str, Iterable]) -> Iterator[Tuple[int, List[Tuple[str, object]]]]:
+    """
+    k-way merge of per-symbol bar streams, each sorted by bar["timestamp"]. Yields (timestamp, [(symbol, bar)])
+    with every bar sharing that timestamp, holding only one pending bar per symbol.
+    """
+    heap = []
+    for idx, (symbol, stream) in enumerate(streams.items()):
+        it = iter(stream)
+        bar = next(it, None)
+        if bar is not None:
+            # idx breaks timestamp ties so bars themselves are never compared
+            heap.append((bar["timestamp"], idx, symbol, bar, it))
+    heapq.heapify(heap)
+    while heap:
+        timestamp = heap[0][0]
+        batch = []
+        while heap and heap[0][0] == timestamp:
+            _, idx, symbol, bar, it = heap[0]
+            batch.append((symbol, bar))
+            next_bar = next(it, None)
+            if next_bar is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (next_bar["timestamp"], idx, symbol, next_bar, it))
+        yield timestamp, batch
+
+
+def iter_df_bars(df: pd.DataFrame) -> Iterator[dict]:
+    for row in df.sort_values("timestamp").itertuples(index=False):
+        yield row._asdict()
+
+
+class MergedBarHandler:
+    """
+    Data handler over independent per-symbol bar streams (e.g. one read_ohlc frame per symbol).
+    Each update_bars emits all bars of the next timestamp as one MarketBatchEvent, or as separate
+    MarketEvents with batch=False. Every bar carries its symbol, as ReplayDataHandler bars do.
+    """
+
+    def __init__(self, streams: Dict[str, Iterable], batch: bool = True) -> None:
+        self.symbol_list = list(streams.keys())
+        self.batch = batch
+        self.option_metadata_info = None
+        self._merged = merge_bar_streams(streams)
+        self._next = next(self._merged, None)
+        self.continue_backtest = self._next is not None
+        # frames the streams were built from (from_dataframes), needed to copy the handler for sweep runs
+        self._source_dfs = None
+        self._last_timestamp = None
+
+    @classmethod
+    def from_dataframes(cls, dfs: Dict[str, pd.DataFrame], batch: bool = True, frequency: str = None):
+        """frequency resamples the frames on the fly to any multiple of their own frequency, eg 5minute -> 45minute"""
+        if frequency is not None:
+            dfs = {symbol: resample_bars(df, frequency) for symbol, df in dfs.items()}
+        # sorted once so get_latest_bars can binary search them
+        dfs = {
+            symbol: df.sort_values("timestamp").assign(symbol=symbol).reset_index(drop=True)
+            for symbol, df in dfs.items()
+        }
+        handler = cls({symbol: iter_df_bars(df) for symbol, df in dfs.items()}, batch=batch)
+        handler._source_dfs = dfs
+        return handler
+
+    @classmethod
+    def from_disk(cls, symbols: List[str], frequency: str, start_ms: int, end_ms: int, inst_type: str = "equity",
+                  store_format: str = "parquet", batch: bool = True):
+        """Bars in [start_ms, end_ms) of the ohlc files get_data writes, in any of its store formats"""
+        multiplier, time_scale = parse_frequency(frequency)
+        dfs = {}
+        for symbol in symbols:
+            df = read_ohlc(get_ohlc_fp(multiplier, time_scale, symbol, inst_type, store_format), start_ms, end_ms)
+            if not df.empty:
+                dfs[symbol] = df
+        return cls.from_dataframes(dfs, batch=batch)
+
+    def __deepcopy__(self, memo):
+        # generators cannot be copied, so a copy re-merges the (shared) source frames up to the same position
+        if self._source_dfs is None:
+            raise TypeError("MergedBarHandler over plain iterators cannot be copied, build it with from_dataframes")
+        handler = type(self).from_dataframes(self._source_dfs, batch=self.batch)
+        if self._last_timestamp is not None:
+            handler.seek(self._last_timestamp + 1)
+        return handler
+
+    def _advance(self):
+        self._last_timestamp = self._next[0]
+        self._next = next(self._merged, None)
+        self.continue_backtest = self._next is not None
+
+    def seek(self, start_ms: int):
+        """Skips the bars before start_ms"""
+        while self.continue_backtest and self._next[0] < start_ms:
+            self._advance()
+
+    def update_bars(self, event_queue, live: bool = False):
+        if not self.continue_backtest:
+            return
+        timestamp, bars = self._next
+        self._advance()
+        for symbol, bar in bars:
+            if "symbol" not in bar:
+                bar["symbol"] = symbol
+        market_events = [MarketEvent(symbol, bar) for symbol, bar in bars]
+        if self.batch:
+            event_queue.append(MarketBatchEvent(timestamp, market_events))
+        else:
+            event_queue.extend(market_events)
+
+    def get_latest_bars(self, symbol: str, N: int = 1) -> List[dict]:
+        """Last N bars of symbol already emitted"""
+        if self._source_dfs is None:
+            raise TypeError("MergedBarHandler over plain iterators keeps no history, build it with from_dataframes")
+        df = self._source_dfs.get(symbol)
+        if df is None or self._last_timestamp is None:
+            return []
+        end = int(df["timestamp"].searchsorted(self._last_timestamp, side="right"))
+        return df.iloc[max(end - N, 0):end].to_dict("records")
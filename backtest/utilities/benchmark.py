@@ -0,0 +1,192 @@
+import argparse
+import contextlib
+import os
+import queue
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from backtest.performance import create_drawdowns
+from backtest.utilities.events import MarketEvent, OrderQueue
+
+
+def _create_drawdowns_loop(equity_curve):
+    # reference row-by-row implementation that create_drawdowns replaced
+    hwm = [0]
+    eq_idx = equity_curve.index
+    drawdown = pd.Series(index=eq_idx, dtype='float64')
+    duration = pd.Series(index=eq_idx, dtype='float64')
+
+    for t in range(1, len(eq_idx)):
+        cur_hwm = max(hwm[t-1], equity_curve.iloc[t])
+        hwm.append(cur_hwm)
+        drawdown.iloc[t] = hwm[t] - equity_curve.iloc[t]
+        duration.iloc[t] = 0 if drawdown.iloc[t] == 0 else duration.iloc[t-1] + 1
+
+    return drawdown.max(), duration.max()
+
+
+def _handle_event_chain(bt):
+    # reference string-comparison dispatch with a locked order queue that Backtest._handle_event replaced
+    profiler = bt.profiler
+    while True:
+        try:
+            event = bt.event_queue.pop()
+        except IndexError:
+            break
+        else:
+            if event is not None:
+                profiler.next_event()
+                if event.type == "MARKET":
+                    market_bar = event.data
+                    t0 = profiler.start()
+                    option_dt_updated = bt.portfolio.update_option_datetime(market_bar, bt.event_queue)
+                    profiler.stop("update_option_datetime", event.symbol, t0)
+                    if not option_dt_updated:
+                        continue
+                    t0 = profiler.start()
+                    timeindex_updated = bt.portfolio.update_timeindex(market_bar, bt.event_queue)
+                    profiler.stop("update_timeindex", event.symbol, t0)
+                    if timeindex_updated:
+                        bt._update_metrics(market_bar)
+                        inst = bt.portfolio.current_holdings[event.symbol]
+                        t0 = profiler.start()
+                        signal_list = bt.strategy.calculate_signals(event, inst=inst)
+                        profiler.stop("calculate_signals", event.symbol, t0)
+                        for signal in signal_list:
+                            bt.event_queue.appendleft(signal)
+                        while not bt.order_queue.empty():
+                            bt.event_queue.append(bt.order_queue.get())
+                elif event.type == "SIGNAL":
+                    t0 = profiler.start()
+                    bt.portfolio.update_signal(event, bt.event_queue)
+                    profiler.stop("update_signal", event.symbol, t0)
+                elif event.type == "ORDER":
+                    t0 = profiler.start()
+                    executed = bt.broker.execute_order(event, bt.event_queue, bt.order_queue)
+                    profiler.stop("execute_order", event.symbol, t0)
+                elif event.type == "FILL":
+                    print("[FILLED]\t", event.order_event.details())
+                    t0 = profiler.start()
+                    bt.portfolio.update_fill(event, False)
+                    profiler.stop("update_fill", event.order_event.symbol, t0)
+                    order = event.order_event
+                    bt.metrics.update_fill(order.quantity * order.trade_price)
+
+
+class _BenchEvent(SimpleNamespace):
+    def details(self):
+        return f"{self.type} {self.symbol}"
+
+
+class _BenchPortfolio:
+    # minimal portfolio that turns every signal into an order, so all four event types go through dispatch
+    def __init__(self, symbols) -> None:
+        self.current_holdings = {sym: 0 for sym in symbols}
+        self.current_holdings.update(total=1e5, cash=1e5)
+
+    def update_option_datetime(self, market_bar, event_queue):
+        return True
+
+    def update_timeindex(self, market_bar, event_queue):
+        return True
+
+    def update_signal(self, event, event_queue):
+        event_queue.appendleft(_BenchEvent(type="ORDER", symbol=event.symbol, quantity=1, trade_price=1.0))
+
+    def update_fill(self, event, live):
+        pass
+
+
+class _BenchStrategy:
+    def __init__(self, signal_every: int) -> None:
+        self.signal_every = signal_every
+        self.num_calls = 0
+
+    def calculate_signals(self, event, inst=None):
+        self.num_calls += 1
+        if self.num_calls % self.signal_every:
+            return []
+        return [_BenchEvent(type="SIGNAL", symbol=event.symbol)]
+
+
+class _BenchBroker:
+    def execute_order(self, event, event_queue, order_queue):
+        order_queue.put(_BenchEvent(type="FILL", order_event=event))
+        return False
+
+
+def _synthetic_market_events(num_bars: int, num_symbols: int = 10):
+    symbols = [f"SYM{i}" for i in range(num_symbols)]
+    return symbols, [
+        MarketEvent(symbols[i % num_symbols], {"timestamp": 60_000 * (i // num_symbols), "close": 1.0})
+        for i in range(num_bars)
+    ]
+
+
+def bench_events(num_bars: int, signal_every: int = 20):
+    from backtest.utilities.backtest import Backtest
+
+    symbols, market_events = _synthetic_market_events(num_bars)
+    results = {}
+    for label, order_queue, handle_event in [
+        ("string chain + queue.Queue", queue.Queue, _handle_event_chain),
+        ("dispatch table + deque", OrderQueue, Backtest._handle_event),
+    ]:
+        bt = Backtest(SimpleNamespace(
+            data_provider=None,
+            strategy=_BenchStrategy(signal_every),
+            portfolio=_BenchPortfolio(symbols),
+            broker=_BenchBroker(),
+            num_runs=2,
+        ))
+        bt.order_queue = order_queue()
+        num_events = num_bars + 3 * (num_bars // signal_every)
+        start = time.time()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for event in market_events:
+                bt.event_queue.append(event)
+                handle_event(bt)
+        elapsed = time.time() - start
+        results[label] = num_events / elapsed
+        print(f"{label:28s} {elapsed:.2f}s -> {num_events / elapsed:,.0f} events/s")
+    before, after = results.values()
+    print(f"speedup:    {after / before:.2f}x")
+
+
+def _synthetic_equity_curve(num_bars: int, seed: int = 0) -> pd.Series:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0, 1e-3, num_bars)
+    idx = pd.date_range("2020-01-01", periods=num_bars, freq="min")
+    return pd.Series((1.0 + returns).cumprod(), index=idx)
+
+
+def bench_drawdowns(num_bars: int):
+    equity_curve = _synthetic_equity_curve(num_bars)
+
+    start = time.time()
+    vec_res = create_drawdowns(equity_curve)
+    vec_time = time.time() - start
+
+    start = time.time()
+    loop_res = _create_drawdowns_loop(equity_curve)
+    loop_time = time.time() - start
+
+    print(f"bars={num_bars}")
+    print(f"loop:       {loop_time:.4f}s -> {loop_res}")
+    print(f"vectorized: {vec_time:.4f}s -> {vec_res}")
+    print(f"speedup:    {loop_time / max(vec_time, 1e-9):.1f}x")
+    assert np.isclose(vec_res[0], loop_res[0]), "max drawdown mismatch"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro benchmarks for backtest internals.")
+    parser.add_argument("bench", choices=["drawdowns", "events"])
+    parser.add_argument("--num-bars", type=int, default=None, help="defaults to 100k for drawdowns, 1m for events")
+    args = parser.parse_args()
+    if args.bench == "drawdowns":
+        bench_drawdowns(args.num_bars or 100_000)
+    elif args.bench == "events":
+        bench_events(args.num_bars or 1_000_000)
@@ -0,0 +1,67 @@
+from collections import deque
+from enum import Enum
+
+import numpy as np
+
+
+class EventType(str, Enum):
+    # str-valued so handler tables keyed on EventType also match the plain "MARKET"/... tags of trading.event
+    MARKET = "MARKET"
+    SIGNAL = "SIGNAL"
+    ORDER = "ORDER"
+    FILL = "FILL"
+    MARKET_BATCH = "MARKET_BATCH"
+
+
+class MarketEvent:
+    """Slotted market event for the replay feeds, duck-compatible with trading.event.MarketEvent"""
+
+    __slots__ = ("symbol", "data")
+    type = EventType.MARKET
+
+    def __init__(self, symbol: str, data) -> None:
+        self.symbol = symbol
+        self.data = data
+
+
+class MarketBatchEvent:
+    """
+    All MarketEvents sharing one timestamp, so the portfolio can advance its time index once per timestamp.
+    bars optionally holds the same bars as one structured array, which bars_panel then slices without copying.
+    """
+
+    __slots__ = ("timestamp", "events", "bars")
+    type = EventType.MARKET_BATCH
+
+    def __init__(self, timestamp: int, events: list, bars: np.ndarray = None) -> None:
+        self.timestamp = timestamp
+        self.events = events
+        self.bars = bars
+
+
+def bars_panel(market_events: list, bars: np.ndarray = None) -> dict:
+    """Columnar view of one timestamp's bars: {"symbol": array, field: array, ...} aligned by position"""
+    if bars is not None and len(bars) == len(market_events):
+        panel = {field: bars[field] for field in bars.dtype.names}
+    else:
+        first = market_events[0].data
+        fields = first.dtype.names if isinstance(first, np.void) else list(first.keys())
+        panel = {field: np.array([e.data[field] for e in market_events]) for field in fields}
+    panel["symbol"] = np.array([e.symbol for e in market_events])
+    return panel
+
+
+class OrderQueue(deque):
+    """Lock-free stand-in for queue.Queue when the broker runs on the backtest thread"""
+
+    def put(self, item, block=True, timeout=None):
+        self.append(item)
+
+    def get(self, block=True, timeout=None):
+        return self.popleft()
+
+    def empty(self) -> bool:
+        return not self
+
+    def qsize(self) -> int:
+        return len(self)
@@ -2,7 +2,8 @@ import threading
 import time
 
 from decimal import Decimal
-from sqlalchemy import text
+
+import pandas as pd
 
 from ibapi.client import *
 from ibapi.wrapper import *
@@ -10,7 +11,7 @@ from ibapi.contract import Contract
 from ibapi.order import *
 from ibapi.utils import floatMaxString, decimalMaxString
 
-from backtest.utilities.utils import get_db_engine
+from backtest.utilities.utils import bulk_upsert, get_db_engine
 
 
 class IBClient(EWrapper, EClient):
@@ -25,6 +26,7 @@ class IBClient(EWrapper, EClient):
         self.create_tws_connection()
         self.symbols = []
         self.portfolio_detail = dict()
+        self._contract_details = []
 
     def create_tws_connection(self) -> None:
         def run_loop():
@@ -46,19 +48,18 @@ class IBClient(EWrapper, EClient):
         details_dict['category'] = contractDetails.category
         details_dict['subcategory'] = contractDetails.subcategory
         print(reqId, details_dict)
-        # save to db
-        insert_sql = f""" INSERT INTO ibkr.symbol_info (symbol, secType, primaryExchange, industry, category, subCategory)
-            VALUES ('{contractDetails.contract.symbol}', '{contractDetails.contract.secType}', 
-                    '{contractDetails.contract.primaryExchange}', '{contractDetails.industry}',
-                    '{contractDetails.category}', '{contractDetails.subcategory}')
-        """
-        insert_sql = text(insert_sql)
-        with self.eng.connect() as conn:
-            conn.execute(insert_sql)
-            conn.commit()
+        # buffered, saved to db in one bulk write on contractDetailsEnd
+        self._contract_details.append({k.lower(): v for k, v in details_dict.items()})
 
     def contractDetailsEnd(self, reqId: int):
         print("ContractDetailsEnd. ReqId:", reqId)
+        self.flush_contract_details()
+
+    def flush_contract_details(self):
+        if not self._contract_details:
+            return
+        rows, self._contract_details = self._contract_details, []
+        bulk_upsert(pd.DataFrame(rows), "ibkr.symbol_info", ["symbol"], engine=self.eng)
 
     def clear_symbols(self):
         self.symbols.clear()
@@ -0,0 +1,116 @@
+import atexit
+import json
+import logging
+import pickle
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+JOURNAL_FORMATS = ["jsonl", "pickle"]
+JOURNAL_LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING, "OFF": logging.CRITICAL + 1}
+
+
+class EventJournal:
+    """
+    Level-gated structured log for the event loop. log() appends a raw (ts, level, kind, fields) tuple to a
+    buffer and returns, formatting and file writes happen on a background flush thread (or inline once the
+    buffer holds capacity records, so memory stays bounded and nothing is dropped).
+    A disabled level costs one int compare. fp=None or level OFF disables the journal entirely.
+    """
+
+    def __init__(self, fp=None, level=logging.INFO, fmt: str = "jsonl", capacity: int = 1 << 16,
+                 flush_interval: float = 1.0) -> None:
+        assert fmt in JOURNAL_FORMATS, f"fmt should be one of {JOURNAL_FORMATS}"
+        self.level = level if fp is not None else JOURNAL_LEVELS["OFF"]
+        self.fp = Path(fp) if fp is not None else None
+        self.fmt = fmt
+        self.flush_interval = flush_interval
+        self._buffer = deque()
+        self._capacity = capacity
+        self._high_water = capacity // 2
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+        if self.level <= logging.CRITICAL:
+            self.fp.parent.mkdir(parents=True, exist_ok=True)
+            self._fout = open(self.fp, "w" if fmt == "jsonl" else "wb")
+            self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def log(self, level: int, kind: str, **fields):
+        if level < self.level:
+            return
+        self._buffer.append((time.time(), level, kind, fields))
+        if len(self._buffer) >= self._high_water:
+            self._wake.set()
+            if len(self._buffer) >= self._capacity:
+                # the flush thread fell a full buffer behind, write inline rather than drop or grow
+                self._flush()
+
+    def debug(self, kind: str, **fields):
+        if logging.DEBUG >= self.level:
+            self.log(logging.DEBUG, kind, **fields)
+
+    def info(self, kind: str, **fields):
+        if logging.INFO >= self.level:
+            self.log(logging.INFO, kind, **fields)
+
+    def _drain(self) -> list:
+        records = []
+        while True:
+            try:
+                records.append(self._buffer.popleft())
+            except IndexError:
+                return records
+
+    def _write(self, records: list):
+        if not records:
+            return
+        if self.fmt == "jsonl":
+            self._fout.writelines(
+                json.dumps(dict(ts=ts, level=logging.getLevelName(level), kind=kind, **fields), default=str) + "\n"
+                for ts, level, kind, fields in records
+            )
+        else:
+            pickle.dump(records, self._fout, protocol=pickle.HIGHEST_PROTOCOL)
+        self._fout.flush()
+
+    def _flush(self):
+        with self._write_lock:
+            self._write(self._drain())
+
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush()
+
+    def close(self):
+        if self._thread is None or self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+        self._flush()
+        self._fout.close()
+
+
+def read_journal(fp):
+    """Yields journal records as dicts from either format"""
+    fp = Path(fp)
+    if fp.suffix == ".jsonl":
+        with open(fp) as fin:
+            for line in fin:
+                yield json.loads(line)
+        return
+    with open(fp, "rb") as fin:
+        while True:
+            try:
+                records = pickle.load(fin)
+            except EOFError:
+                return
+            for ts, level, kind, fields in records:
+                yield dict(ts=ts, level=logging.getLevelName(level), kind=kind, **fields)
@@ -0,0 +1,144 @@
+import datetime
+import functools
+import hashlib
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+from pathlib import Path
+from typing import Callable, List
+
+import pandas as pd
+
+from backtest.utilities.sweep import run_sweep
+
+OPTIMIZE_METHODS = ["grid", "random", "halving"]
+
+
+def param_hash(params: dict) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def data_key(args) -> str:
+    """Hash of the inputs that decide which bars a run sees, so cached scores never cross data windows"""
+    data_config_fp = getattr(args, "data_config_fp", None)
+    data_config = Path(data_config_fp).read_bytes().decode() if data_config_fp and Path(data_config_fp).exists() else ""
+    # an open-ended window ends now, so it only matches runs of the same day
+    end_ms = getattr(args, "end_ms", None) or datetime.date.today().isoformat()
+    return param_hash(dict(
+        data_config=data_config,
+        start_ms=getattr(args, "start_ms", None),
+        end_ms=end_ms,
+        replay=getattr(args, "replay", False),
+        replay_frequency=getattr(args, "replay_frequency", None),
+        from_disk=getattr(args, "from_disk", None),
+        frequency=getattr(args, "frequency", None),
+    ))
+
+
+def get_candidates(param_space: dict, method: str, num_candidates=None, seed=None) -> List[dict]:
+    # param_space maps a get_config kwarg to the list of values to try
+    keys = list(param_space.keys())
+    grid = [dict(zip(keys, values)) for values in itertools.product(*param_space.values())]
+    if method == "grid" or num_candidates is None or num_candidates >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, num_candidates)
+
+
+class ResultCache:
+    """
+    One json file per (param hash, bar budget) so an interrupted sweep resumes where it stopped.
+    optimize keeps one cache_dir per config and data_key.
+    """
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _fp(self, params: dict, max_bars) -> Path:
+        return self.cache_dir / f"{param_hash(params)}_{max_bars or 'full'}.json"
+
+    def get(self, params: dict, max_bars):
+        fp = self._fp(params, max_bars)
+        if not fp.exists():
+            return None
+        with open(fp, "r") as fin:
+            return json.load(fin)["stats"]
+
+    def put(self, params: dict, max_bars, stats: dict):
+        fp = self._fp(params, max_bars)
+        tmp_fp = fp.with_suffix(".tmp")
+        with open(tmp_fp, "w") as fout:
+            json.dump(dict(params=params, max_bars=max_bars, stats=stats), fout, default=float)
+        os.replace(tmp_fp, fp)
+
+
+def _run_candidate(args, data_provider, run_fn: Callable) -> dict:
+    model_args = importlib.import_module(f"backtest.config.{args.config_name}").get_config(**args.params)
+    args.strategy = model_args["strategy"]
+    args.portfolio = model_args["portfolio"]
+    return run_fn(args, data_provider)
+
+
+def _evaluate(args, load_fn, run_fn, cache: ResultCache, candidates: List[dict], max_bars, num_workers) -> List[dict]:
+    to_run = [params for params in candidates if cache.get(params, max_bars) is None]
+    if to_run:
+        results_df = run_sweep(
+            args,
+            load_fn,
+            functools.partial(_run_candidate, run_fn=run_fn),
+            [
+                dict(params=params, max_bars=max_bars, run_tag=f"{param_hash(params)}_{max_bars or 'full'}")
+                for params in to_run
+            ],
+            num_workers,
+        )
+        for params, (_, row) in zip(to_run, results_df.iterrows()):
+            cache.put(params, max_bars, row.drop(["params", "max_bars", "run_tag"]).to_dict())
+    return [cache.get(params, max_bars) for params in candidates]
+
+
+def optimize(
+    args,
+    load_fn: Callable,
+    run_fn: Callable,
+    method: str = "grid",
+    num_candidates=None,
+    num_workers: int = 4,
+    metric: str = "sharpe",
+    min_bars: int = 1000,
+    eta: int = 3,
+) -> pd.DataFrame:
+    """
+    Searches the PARAM_SPACE of backtest.config.{args.config_name}, whose get_config(**params) builds the
+    strategy/portfolio for one candidate.
+    halving: every candidate runs min_bars bars, the top 1/eta by metric go on with eta times the bars,
+    and the last rung is a full run.
+    """
+    assert method in OPTIMIZE_METHODS, f"method has to be one of {OPTIMIZE_METHODS}"
+    assert method != "random" or num_candidates is not None, "--num-candidates is required with --optimize random"
+    param_space = importlib.import_module(f"backtest.config.{args.config_name}").PARAM_SPACE
+    candidates = get_candidates(param_space, method, num_candidates)
+    cache = ResultCache(Path(os.environ["DATA_DIR"]) / f"optimize/{args.config_name}/{data_key(args)}")
+
+    budgets = [None]
+    if method == "halving":
+        num_rungs = max(math.ceil(math.log(len(candidates), eta)), 1)
+        budgets = [min_bars * eta**i for i in range(num_rungs - 1)] + [None]
+
+    data_provider = None
+    rows = []
+    for max_bars in budgets:
+        print(f"evaluating {len(candidates)} candidates with max_bars={max_bars or 'full'}")
+        if data_provider is None and any(cache.get(params, max_bars) is None for params in candidates):
+            data_provider = load_fn(args)
+        stats = _evaluate(args, lambda _: data_provider, run_fn, cache, candidates, max_bars, num_workers)
+        rung_df = pd.concat([pd.DataFrame(candidates), pd.DataFrame(stats)], axis=1)
+        rung_df["max_bars"] = max_bars
+        rung_df = rung_df.sort_values(metric, ascending=False)
+        rows.append(rung_df)
+        num_keep = max(len(candidates) // eta, 1)
+        candidates = [candidates[i] for i in rung_df.index[:num_keep]]
+    return pd.concat(rows, ignore_index=True)
@@ -1,14 +1,23 @@
 import datetime
 import os
+from pathlib import Path
+from typing import Dict
 
+import numpy as np
 import pandas as pd
 
 from backtest.utilities.utils import OPTION_METADATA_PATH
 
 _TICKER_INT_COLS = ["ticker", "expiration_date"]
+_CATEGORICAL_COLS = ["underlying_sym", "contract_type", "exercise_style", "primary_exchange", "cfi"]
 
 
 class OptionMetadata:
+    """
+    Lazily loaded option metadata, sorted by (underlying_sym, expiration_date, strike_price) with the row
+    range of every underlying indexed up front, so per-underlying lookups are a slice instead of a scan
+    and expiry ranges within an underlying are a binary search.
+    """
     DATA_INITIALIZED = False
 
     def __new__(cls):
@@ -18,87 +27,126 @@ class OptionMetadata:
 
     def _initialize(self):
         if not self.DATA_INITIALIZED:
-            self.data: pd.DataFrame = pd.read_csv(OPTION_METADATA_PATH, index_col=None)
+            data = pd.read_csv(OPTION_METADATA_PATH, index_col=None, dtype={c: "category" for c in _CATEGORICAL_COLS})
+            data["expiration_date"] = pd.to_datetime(data["expiration_date"], errors="coerce")
+            self.data: pd.DataFrame = data.sort_values(
+                ["underlying_sym", "expiration_date", "strike_price"], kind="stable", ignore_index=True
+            )
+            und_codes = self.data["underlying_sym"].cat.codes.to_numpy()
+            boundaries = np.flatnonzero(np.diff(und_codes)) + 1
+            starts = np.concatenate(([0], boundaries))
+            stops = np.concatenate((boundaries, [len(und_codes)]))
+            self._und_slices = {
+                self.data["underlying_sym"].iat[start]: (start, stop)
+                for start, stop in zip(starts, stops)
+                if stop > start and und_codes[start] != -1
+            }
+            # NaT sorts last, so it has to map to the largest int for the array to stay sorted per underlying
+            expiration = self.data["expiration_date"]
+            self._expiration_ns = np.where(
+                expiration.isna(), np.iinfo(np.int64).max, expiration.to_numpy().astype("datetime64[ns]").astype("int64")
+            )
             self.DATA_INITIALIZED = True
 
+    def invalidate(self):
+        # metadata file was appended to, reload on next access
+        self.DATA_INITIALIZED = False
+
     def get_option_metadata(self):
         self._initialize()
         return self.data.copy()
 
-    def get_option_metadata_for_symbol(self, symbol):
+    def _get_slice(self, symbol, date_from=None, date_to=None) -> slice:
+        start, stop = self._und_slices.get(symbol, (0, 0))
+        expiration_ns = self._expiration_ns[start:stop]
+        if date_from is not None:
+            start += np.searchsorted(expiration_ns, pd.Timestamp(date_from).value, side="left")
+        if date_to is not None:
+            stop = start + np.searchsorted(self._expiration_ns[start:stop], pd.Timestamp(date_to).value, side="right")
+        return slice(start, max(start, stop))
+
+    def get_option_metadata_for_symbol(self, symbol, date_from=None, date_to=None):
+        """Metadata of one underlying, optionally restricted to date_from <= expiration_date <= date_to"""
         self._initialize()
-        return self.data.query("underlying_sym == @symbol").copy()
+        return self.data.iloc[self._get_slice(symbol, date_from, date_to)].copy()
+
+    def get_option_metadata_for_symbols(self, symbols, date_from=None, date_to=None):
+        """Same as get_option_metadata_for_symbol for a list of underlyings, gathered with a single take"""
+        self._initialize()
+        slices = [self._get_slice(symbol, date_from, date_to) for symbol in symbols]
+        row_idx = np.concatenate([np.arange(sl.start, sl.stop) for sl in slices] + [np.empty(0, dtype=np.int64)])
+        return self.data.take(row_idx)
+
+
+def get_latest_close(underlying: str, block_size: int = 4096) -> float:
+    """Close of the last row of day/equity/{underlying}.csv, read from the file tail instead of parsing the file"""
+    fp = Path(os.environ["DATA_DIR"]) / f"day/equity/{underlying}.csv"
+    with open(fp, "rb") as fin:
+        header = fin.readline().decode().strip().split(",")
+        end = fin.seek(0, os.SEEK_END)
+        fin.seek(max(0, end - block_size))
+        last_row = fin.read().strip().split(b"\n")[-1].decode().split(",")
+    return float(last_row[header.index("close")])
+
+
+def select_option_tickers_near_price(
+    underlying_list, latest_prices: Dict[str, float], date_from, date_to, num_closest_strikes: int
+) -> Dict[str, pd.Timestamp]:
+    """
+    Batch strike-window selection over the whole universe in one grouped pass. For every
+    (underlying, expiration) within [date_from, date_to], keeps the num_closest_strikes + 1 distinct strikes
+    nearest to the underlying's latest price below it, and as many at or above it.
+    Returns a map of option ticker to expiration date.
+    """
+    info_df = OptionMetadata().get_option_metadata_for_symbols(underlying_list, date_from, date_to).loc[
+        :, ["underlying_sym", "expiration_date", "strike_price", "ticker"]
+    ]
+    price = info_df["underlying_sym"].astype(object).map(latest_prices).astype("float64")
+    info_df = info_df.assign(
+        strike_dist=(info_df["strike_price"] - price).abs(), above=info_df["strike_price"] >= price
+    ).dropna(subset=["strike_dist"])
+    # dense over the distance within one side is the rank of the distinct strike, calls and puts share it
+    strike_rank = info_df.groupby(["underlying_sym", "expiration_date", "above"], observed=True)["strike_dist"].rank(
+        method="dense"
+    )
+    info_df = info_df.loc[strike_rank <= num_closest_strikes + 1]
+    return dict(zip(info_df["ticker"], info_df["expiration_date"]))
 
 
 def get_option_ticker_from_underlying(
     underlying_list, date_from: datetime.datetime, date_to: datetime.datetime, num_closest_strikes=None
-) -> dict:
+) -> Dict[str, pd.Timestamp]:
     # add feature to get around certain strike prices, based on underlying prices during the period
     # num_closest_strikes should only be applied to live operations
     # returns a map of available tickers to expiration date
-    option_tickers = {}
-    for underlying in underlying_list:
-        try:
-            underlying_option_info_df = OptionMetadata().get_option_metadata_for_symbol(underlying)
-            if underlying_option_info_df.empty:
+    option_metadata = OptionMetadata()
+    if num_closest_strikes is None:
+        option_tickers = {}
+        for underlying in underlying_list:
+            tickers_info_df = option_metadata.get_option_metadata_for_symbol(underlying, date_from, date_to)
+            if tickers_info_df.empty:
                 print(f"no underlying_sym df: und_sym={underlying}")
                 continue
-            if "expiration_date" not in underlying_option_info_df:
-                print(f"expiration_date not in info_df: underlying={underlying}")
-                continue
-            underlying_option_info_df.expiration_date = pd.to_datetime(underlying_option_info_df.expiration_date)
-            if num_closest_strikes is None:
-                tickers_info = (
-                    underlying_option_info_df.query("@date_from <= expiration_date <= @date_to")
-                    .loc[:, _TICKER_INT_COLS]
-                    .set_index(_TICKER_INT_COLS[0])
-                    .squeeze()
-                    .to_dict()
-                )
-                option_tickers.update(tickers_info)
-            else:
-                # TODO: Don't draw yday close price but most recent.
-                underlying_yday_close_price = pd.read_csv(f"{os.environ['DATA_DIR']}/day/equity/{underlying}.csv").iloc[
-                    -1
-                ]["close"]
-                strike_step = (
-                    underlying_option_info_df.query(
-                        f"contract_type == 'call' and "
-                        f"expiration_date == '{underlying_option_info_df.expiration_date.iloc[-1]}'"
-                    )
-                    .strike_price.diff()
-                    .median()
-                )
-                lb_strike = underlying_yday_close_price - (num_closest_strikes + 1) * strike_step
-                ub_strike = underlying_yday_close_price + (num_closest_strikes + 1) * strike_step
-
-                tickers_info = (
-                    underlying_option_info_df.query(
-                        "@date_from <= expiration_date <= @date_to and " f"@lb_strike <= strike_price <= @ub_strike"
-                    )
-                    .loc[:, _TICKER_INT_COLS]
-                    .set_index(_TICKER_INT_COLS[0])
-                    .squeeze()
-                    .to_dict()
-                )
-                option_tickers.update(tickers_info)
-        except KeyError as e:
-            print("Keyerror", e)
-            continue
-    return option_tickers
+            option_tickers.update(zip(tickers_info_df["ticker"], tickers_info_df["expiration_date"]))
+        return option_tickers
+
+    # TODO: Don't draw yday close price but most recent.
+    latest_prices = {}
+    for underlying in underlying_list:
+        try:
+            latest_prices[underlying] = get_latest_close(underlying)
+        except (OSError, ValueError, IndexError) as e:
+            print(f"no latest close for {underlying}: {e}")
+    return select_option_tickers_near_price(
+        list(latest_prices.keys()), latest_prices, date_from, date_to, num_closest_strikes
+    )
 
 
 def get_option_metadata_info(underlying_list, date_from: datetime.datetime, date_to: datetime.datetime):
-    # option_metadata = []
-    bato = 'BATO'
-    # for underlying in underlying_list:
-    underlying_option_info_df = OptionMetadata().get_option_metadata().query(
-        "underlying_sym in @underlying_list and primary_exchange == @bato"
-    )
-    underlying_option_info_df["expiration_date"] = pd.to_datetime(underlying_option_info_df["expiration_date"])
-    underlying_option_info_df = underlying_option_info_df.query("@date_from <= expiration_date <= @date_to").copy()
+    underlying_option_info_df = OptionMetadata().get_option_metadata_for_symbols(underlying_list, date_from, date_to)
+    underlying_option_info_df = underlying_option_info_df.loc[
+        underlying_option_info_df.primary_exchange == "BATO"
+    ].copy()
     if "correction" in underlying_option_info_df:
         del underlying_option_info_df["correction"]
     return underlying_option_info_df
-    # option_metadata.append(underlying_option_info_df)
-    # return pd.concat(option_metadata)
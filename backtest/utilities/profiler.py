@@ -0,0 +1,94 @@
+import json
+import time
+from collections import defaultdict
+
+_NUM_BUCKETS = 64
+
+
+class _StageStats:
+    __slots__ = ("count", "sampled", "total_ns", "max_ns", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sampled = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        # log2 latency histogram: bucket i holds latencies in [2^i, 2^(i+1)) ns
+        self.buckets = [0] * _NUM_BUCKETS
+
+    def percentile_us(self, q: float) -> float:
+        target = q * self.sampled
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << i) * 1.5 / 1e3  # bucket midpoint
+        return 0.0
+
+
+class EventLoopProfiler:
+    """
+    Per-stage counters and latency histograms keyed by (stage, symbol) for the backtest event loop.
+    Every event is counted but only one in sample_every is timed, so it is cheap enough to leave on in long
+    backtests. Live runs use sample_every=1 so every bar's stage breakdown is complete.
+    start() returns 0 for unsampled events and stop() then only counts.
+    """
+
+    def __init__(self, sample_every: int = 1, enabled: bool = True) -> None:
+        self.sample_every = max(sample_every, 1)
+        self.enabled = enabled
+        self.stats = defaultdict(_StageStats)
+        self._num_events = 0
+        self._sampled = enabled
+        # ns per stage since the last reset_bar(), used to attribute a slow live bar
+        self.bar_breakdown = defaultdict(int)
+
+    def next_event(self):
+        self._num_events += 1
+        self._sampled = self.enabled and self._num_events % self.sample_every == 0
+
+    def start(self) -> int:
+        return time.perf_counter_ns() if self._sampled else 0
+
+    def stop(self, stage: str, symbol, start_ns: int):
+        if not self.enabled:
+            return
+        stats = self.stats[(stage, symbol)]
+        stats.count += 1
+        if start_ns:
+            elapsed = time.perf_counter_ns() - start_ns
+            stats.sampled += 1
+            stats.total_ns += elapsed
+            stats.max_ns = max(stats.max_ns, elapsed)
+            stats.buckets[min(elapsed.bit_length(), _NUM_BUCKETS) - 1 if elapsed else 0] += 1
+            self.bar_breakdown[stage] += elapsed
+
+    def reset_bar(self):
+        self.bar_breakdown.clear()
+
+    def summary(self, by_symbol: bool = False) -> dict:
+        """stage (or "stage|symbol") -> count, sampled, mean/p50/p99/max latency in us"""
+        merged = defaultdict(_StageStats)
+        for (stage, symbol), stats in self.stats.items():
+            key = f"{stage}|{symbol}" if by_symbol else stage
+            agg = merged[key]
+            agg.count += stats.count
+            agg.sampled += stats.sampled
+            agg.total_ns += stats.total_ns
+            agg.max_ns = max(agg.max_ns, stats.max_ns)
+            agg.buckets = [a + b for a, b in zip(agg.buckets, stats.buckets)]
+        return {
+            key: dict(
+                count=stats.count,
+                sampled=stats.sampled,
+                mean_us=stats.total_ns / stats.sampled / 1e3 if stats.sampled else 0.0,
+                p50_us=stats.percentile_us(0.5),
+                p99_us=stats.percentile_us(0.99),
+                max_us=stats.max_ns / 1e3,
+            )
+            for key, stats in merged.items()
+        }
+
+    def dump_json(self, fp):
+        with open(fp, "w") as fout:
+            json.dump(dict(by_stage=self.summary(), by_symbol=self.summary(by_symbol=True)), fout, indent=2)
@@ -0,0 +1,172 @@
+import copy
+import datetime
+import hashlib
+import os
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from sqlalchemy import text
+
+from backtest.utilities.events import MarketBatchEvent, MarketEvent
+from backtest.utilities.utils import get_db_engine, log_message, read_sql_cached
+
+REPLAY_DIR = Path(os.environ["DATA_DIR"]) / "replay"
+REPLAY_COLUMNS = ["timestamp", "symbol", "open", "high", "low", "close", "volume"]
+# bumped whenever the file layout changes, so stale replay files are recompiled instead of reused
+_REPLAY_VERSION = 2
+# late corrections to a window are picked up by recompiling after this long
+_REPLAY_STATS_TTL = datetime.timedelta(days=1)
+_REPLAY_WHERE = """
+    FROM ibkr.market_data_bars_uniq
+    WHERE frequency = :frequency
+        and symbol = ANY(:symbols)
+        and timestamp >= :start_ms
+        and timestamp < :end_ms
+"""
+
+
+def replay_dtype(symbol_width: int) -> np.dtype:
+    """
+    Bar layout of a replay file. The symbol field is as wide as the longest symbol in the window (OCC option
+    tickers run past 20 characters), the .npy header stores the dtype so readers pick the width up from it.
+    """
+    return np.dtype([
+        ("timestamp", "i8"),
+        ("symbol", f"U{max(symbol_width, 1)}"),
+        ("open", "f8"),
+        ("high", "f8"),
+        ("low", "f8"),
+        ("close", "f8"),
+        ("volume", "f8"),
+    ])
+
+
+def get_replay_fp(symbols: List[str], frequency: str, start_ms: int, end_ms: int) -> Path:
+    key = hashlib.sha1(
+        f"{_REPLAY_VERSION}|{sorted(symbols)}|{frequency}|{start_ms}|{end_ms}".encode()
+    ).hexdigest()[:16]
+    return REPLAY_DIR / f"{key}.npy"
+
+
+def _replay_stats(params: dict, refresh: bool = False):
+    """(row count, longest symbol) of the window, cached since the pre-query scans the whole window"""
+    stats = read_sql_cached(
+        f"SELECT count(*) as num_rows, coalesce(max(length(symbol)), 0) as symbol_width {_REPLAY_WHERE}",
+        params,
+        ttl=_REPLAY_STATS_TTL,
+        refresh=refresh,
+    )
+    return int(stats["num_rows"].iloc[0]), int(stats["symbol_width"].iloc[0])
+
+
+def compile_replay(symbols: List[str], frequency: str, start_ms: int, end_ms: int, chunksize: int = 100_000,
+                   refresh_stats: bool = False) -> Path:
+    """
+    Writes the bars of symbols in [start_ms, end_ms) to a timestamp-sorted structured .npy, streaming the query
+    straight into the memmap so compiling never holds the whole window in memory. Reuses an existing file.
+    """
+    fp = get_replay_fp(symbols, frequency, start_ms, end_ms)
+    if fp.exists():
+        return fp
+    params = dict(frequency=frequency, symbols=list(symbols), start_ms=int(start_ms), end_ms=int(end_ms))
+    num_rows, symbol_width = _replay_stats(params, refresh=refresh_stats)
+    dtype = replay_dtype(symbol_width)
+    REPLAY_DIR.mkdir(parents=True, exist_ok=True)
+    # concurrent compiles of the same window each write their own tmp file, the last rename wins
+    tmp_fp = fp.with_suffix(f".{os.getpid()}.tmp.npy")
+    bars = np.lib.format.open_memmap(tmp_fp, mode="w+", dtype=dtype, shape=(num_rows,))
+    num_filled = 0
+    with get_db_engine().connect().execution_options(stream_results=True, max_row_buffer=chunksize) as conn:
+        result = conn.execute(
+            text(f"SELECT {', '.join(REPLAY_COLUMNS)} {_REPLAY_WHERE} order by timestamp, symbol"), params
+        )
+        while num_filled < num_rows and (rows := result.fetchmany(min(chunksize, num_rows - num_filled))):
+            bars[num_filled:num_filled + len(rows)] = np.array([tuple(row) for row in rows], dtype=dtype)
+            num_filled += len(rows)
+        # a window that gained bars since its stats were cached has rows left over
+        complete = num_filled == num_rows and not result.fetchmany(1)
+    if not complete:
+        del bars
+        tmp_fp.unlink()
+        if not refresh_stats:
+            log_message(f"replay: cached stats of {fp} are stale, recompiling with fresh ones")
+            return compile_replay(symbols, frequency, start_ms, end_ms, chunksize, refresh_stats=True)
+        raise Exception(f"replay compile of {fp} expected {num_rows} rows, got a different number")
+    bars.flush()
+    del bars
+    os.replace(tmp_fp, fp)
+    log_message(f"replay: compiled {num_rows} bars of {len(symbols)} symbols into {fp}")
+    return fp
+
+
+class ReplayDataHandler:
+    """
+    Historical bar handler over a compiled replay file. The file is opened read-only with mmap, so bars are
+    served as views into the page cache and every process of a sweep replaying the same window shares the
+    same physical pages. Each update_bars emits the bars of the next timestamp, as one MarketBatchEvent
+    unless batch=False.
+    """
+
+    def __init__(self, symbol_list: List[str], frequency: str, start_ms: int, end_ms: int, batch: bool = True) -> None:
+        self.symbol_list = list(symbol_list)
+        self.batch = batch
+        self.frequency = frequency
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.fp = compile_replay(self.symbol_list, frequency, start_ms, end_ms)
+        self.bars = np.load(self.fp, mmap_mode="r")
+        # row offsets where a new timestamp starts, plus the end
+        timestamps = self.bars["timestamp"]
+        self._batch_bounds = np.concatenate(
+            [[0], np.flatnonzero(timestamps[1:] != timestamps[:-1]) + 1, [len(self.bars)]]
+        )
+        self._batch_idx = 0
+        self._symbol_rows = {}
+        self.option_metadata_info = None
+        self.continue_backtest = len(self.bars) > 0
+
+    def __getstate__(self):
+        # re-open the mmap after pickling (spawned workers, deepcopy in sweeps) instead of copying the bars
+        state = self.__dict__.copy()
+        del state["bars"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bars = np.load(self.fp, mmap_mode="r")
+
+    def __deepcopy__(self, memo):
+        # the bars and indices are read-only, only the replay position is per copy
+        return copy.copy(self)
+
+    def seek(self, start_ms: int):
+        """Moves the replay to the first timestamp >= start_ms"""
+        self._batch_idx = int(np.searchsorted(self.bars["timestamp"][self._batch_bounds[:-1]], start_ms))
+        self.continue_backtest = self._batch_idx + 1 < len(self._batch_bounds)
+
+    def next_batch(self) -> np.ndarray:
+        """View of the bars sharing the next timestamp"""
+        start, end = self._batch_bounds[self._batch_idx], self._batch_bounds[self._batch_idx + 1]
+        self._batch_idx += 1
+        if self._batch_idx + 1 >= len(self._batch_bounds):
+            self.continue_backtest = False
+        return self.bars[start:end]
+
+    def update_bars(self, event_queue, live: bool = False):
+        if not self.continue_backtest:
+            return
+        bars = self.next_batch()
+        market_events = [MarketEvent(str(bar["symbol"]), bar) for bar in bars]
+        if self.batch:
+            event_queue.append(MarketBatchEvent(int(bars[0]["timestamp"]), market_events, bars=bars))
+        else:
+            event_queue.extend(market_events)
+
+    def get_latest_bars(self, symbol: str, N: int = 1) -> np.ndarray:
+        """Last N bars of symbol already emitted"""
+        if symbol not in self._symbol_rows:
+            self._symbol_rows[symbol] = np.flatnonzero(self.bars["symbol"] == symbol)
+        rows = self._symbol_rows[symbol]
+        end = np.searchsorted(rows, self._batch_bounds[self._batch_idx])
+        return self.bars[rows[max(end - N, 0):end]]
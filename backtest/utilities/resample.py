@@ -0,0 +1,75 @@
+import datetime
+import re
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from trading.utilities.utils import NY_TIMEZONE
+
+SESSION_OPEN = datetime.timedelta(hours=9, minutes=30)
+SESSION_CLOSE = datetime.timedelta(hours=16)
+_TIME_SCALE_MS = {"minute": 60_000, "hour": 3_600_000}
+_FREQ_PATTERN = re.compile(r"^(\d*)(minute|hour|day)$")
+
+
+def parse_frequency(frequency: str) -> Tuple[int, str]:
+    """"15minute" -> (15, "minute"), "day" -> (1, "day")"""
+    match = _FREQ_PATTERN.match(frequency)
+    assert match is not None, f"Unknown frequency {frequency}"
+    multiplier, time_scale = match.groups()
+    return int(multiplier or 1), time_scale
+
+
+def frequency_ms(frequency: str) -> int:
+    multiplier, time_scale = parse_frequency(frequency)
+    return multiplier * _TIME_SCALE_MS.get(time_scale, 86_400_000)
+
+
+def bucket_start_ms(timestamps, frequency: str) -> np.ndarray:
+    """
+    Start (ms) of the frequency bucket each bar timestamp falls in. Intraday buckets are aligned to the NY
+    session open of the bar's own day, so 30minute buckets start at 09:30 and pre-market bars bucket backwards
+    from it. Day buckets start at NY midnight, as polygon day bars do. DST is handled by working in NY time.
+    """
+    multiplier, time_scale = parse_frequency(frequency)
+    local = pd.to_datetime(np.asarray(timestamps, dtype="int64"), unit="ms", utc=True).tz_convert(NY_TIMEZONE)
+    day_start = local.normalize().as_unit("ns").asi8 // 1_000_000
+    if time_scale == "day":
+        assert multiplier == 1, "only single day buckets are supported"
+        return day_start
+    anchor = day_start + int(SESSION_OPEN.total_seconds() * 1000)
+    size = multiplier * _TIME_SCALE_MS[time_scale]
+    return anchor + (local.as_unit("ns").asi8 // 1_000_000 - anchor) // size * size
+
+
+def resample_bars(df: pd.DataFrame, frequency: str, session_only_daily: bool = True) -> pd.DataFrame:
+    """
+    Aggregates bars (timestamp column in ms at the bar start) into coarser frequency bars: first open, max high,
+    min low, last close, summed volume/num_trades and volume weighted vwap. Every bucket touched by df is
+    returned, so the trailing one may be partial; callers updating incrementally pass the base bars from
+    bucket_start_ms of their first new bar and overwrite the buckets they already stored.
+    Day bars only use regular session bars unless session_only_daily=False.
+    """
+    if df.empty:
+        return df
+    df = df.sort_values("timestamp")
+    if parse_frequency(frequency)[1] == "day" and session_only_daily:
+        local = pd.to_datetime(df["timestamp"].to_numpy(dtype="int64"), unit="ms", utc=True).tz_convert(NY_TIMEZONE)
+        time_of_day = local - local.normalize()
+        df = df.loc[(time_of_day >= SESSION_OPEN) & (time_of_day < SESSION_CLOSE)]
+        if df.empty:
+            return df
+    df = df.assign(bucket=bucket_start_ms(df["timestamp"].to_numpy(), frequency))
+    agg = {"open": "first", "high": "max", "low": "min", "close": "last", "volume": "sum"}
+    if "num_trades" in df.columns:
+        agg["num_trades"] = "sum"
+    if "vwap" in df.columns:
+        df = df.assign(price_volume=df["vwap"] * df["volume"])
+        agg["price_volume"] = "sum"
+    out = df.groupby("bucket", sort=True).agg(agg)
+    if "vwap" in df.columns:
+        out["vwap"] = (out["price_volume"] / out["volume"].where(out["volume"] > 0)).fillna(out["close"])
+        out = out.drop(columns="price_volume")
+    out.index.name = "timestamp"
+    return out.reset_index()
@@ -0,0 +1,167 @@
+import datetime
+import time
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import pandas as pd
+
+from backtest.utilities.resample import frequency_ms, parse_frequency
+from trading.utilities.utils import NY_TIMEZONE
+
+SESSION_OPEN = datetime.timedelta(hours=9, minutes=30)
+SESSION_CLOSE = datetime.timedelta(hours=16)
+EARLY_CLOSE = datetime.timedelta(hours=13)
+# get_data starts its live downloads this long after each base bar close, polygon aggregates take a few seconds
+# to settle
+DOWNLOAD_SETTLE = datetime.timedelta(seconds=30)
+# loops reading the bars get_data writes to disk wait for the download and the writes on top of DOWNLOAD_SETTLE
+DISK_READ_SETTLE = DOWNLOAD_SETTLE + datetime.timedelta(seconds=60)
+# long sleeps wake up this often to re-check the clock, so suspend/clock changes do not oversleep
+_MAX_SLEEP_S = 3600
+
+
+def _observed(day: datetime.date) -> datetime.date:
+    # fixed-date holidays on a saturday are observed on friday, on a sunday on monday
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> datetime.date:
+    """n-th (1-based) weekday of the month, n=-1 for the last one"""
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last = next_month - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int) -> datetime.date:
+    # anonymous gregorian algorithm
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+@lru_cache(maxsize=None)
+def nyse_holidays(year: int) -> frozenset:
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),  # MLK day
+        _nth_weekday(year, 2, 0, 3),  # Presidents day
+        _easter(year) - datetime.timedelta(days=2),  # Good Friday
+        _nth_weekday(year, 5, 0, -1),  # Memorial day
+        _observed(datetime.date(year, 7, 4)),
+        _nth_weekday(year, 9, 0, 1),  # Labor day
+        _nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        _observed(datetime.date(year, 12, 25)),
+    }
+    new_year = datetime.date(year, 1, 1)
+    # a saturday new year is not moved back into the previous year
+    if new_year.weekday() != 5:
+        holidays.add(_observed(new_year))
+    if year >= 2022:
+        holidays.add(_observed(datetime.date(year, 6, 19)))
+    return frozenset(holidays)
+
+
+@lru_cache(maxsize=None)
+def nyse_early_closes(year: int) -> frozenset:
+    candidates = [
+        datetime.date(year, 7, 3),
+        _nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1),  # day after Thanksgiving
+        datetime.date(year, 12, 24),
+    ]
+    return frozenset(day for day in candidates if day.weekday() < 5 and day not in nyse_holidays(year))
+
+
+class MarketCalendar:
+    """NYSE regular sessions: weekends and exchange holidays are closed, half-days close at 13:00 NY"""
+
+    def __init__(self, extra_holidays=()) -> None:
+        # ad hoc closures (national days of mourning etc.) as datetime.date
+        self.extra_holidays = set(extra_holidays)
+
+    def session(self, day) -> Optional[Tuple[pd.Timestamp, pd.Timestamp]]:
+        """(open, close) in NY time of the session on day, None if the market is closed that day"""
+        date = pd.Timestamp(day).date()
+        if date.weekday() > 4 or date in nyse_holidays(date.year) or date in self.extra_holidays:
+            return None
+        midnight = pd.Timestamp(date).tz_localize(NY_TIMEZONE)
+        close = EARLY_CLOSE if date in nyse_early_closes(date.year) else SESSION_CLOSE
+        return midnight + SESSION_OPEN, midnight + close
+
+    def next_session(self, now: pd.Timestamp) -> Tuple[pd.Timestamp, pd.Timestamp]:
+        """Session in progress at now, or the next one to open"""
+        day = now.tz_convert(NY_TIMEZONE).normalize()
+        while True:
+            session = self.session(day)
+            if session is not None and session[1] > now:
+                return session
+            # 36h then normalize steps exactly one calendar day across DST changes
+            day = (day + pd.Timedelta(hours=36)).normalize()
+
+
+def end_of_trading_week(now: pd.Timestamp, cutoff: datetime.timedelta = datetime.timedelta(hours=18)):
+    """Friday midnight + cutoff (NY) of now's week, live loops stop after it and restart for the next week"""
+    now = now.tz_convert(NY_TIMEZONE)
+    friday = (now.normalize() + pd.Timedelta(days=4 - now.dayofweek)).normalize()
+    return friday + cutoff
+
+
+class BarScheduler:
+    """
+    Wakes live loops at each bar close of frequency (bars aligned to the session open, day bars at the
+    session close) plus settle, giving the data source time to publish the bar. Outside sessions it
+    sleeps straight through to the first bar close of the next session.
+    """
+
+    def __init__(self, frequency: str, settle: datetime.timedelta = datetime.timedelta(seconds=5),
+                 calendar: MarketCalendar = None) -> None:
+        self.frequency = frequency
+        self.settle = pd.Timedelta(settle)
+        self.calendar = MarketCalendar() if calendar is None else calendar
+        is_daily = parse_frequency(frequency)[1] == "day"
+        self._bar_size = None if is_daily else pd.Timedelta(frequency_ms(frequency), "ms")
+
+    def _bar_closes(self, session_open: pd.Timestamp, session_close: pd.Timestamp):
+        if self._bar_size is None:
+            return [session_close]
+        closes = list(pd.date_range(session_open + self._bar_size, session_close, freq=self._bar_size))
+        # a bar cut short by the close (eg 60minute bars, half-days) closes with the session
+        if not closes or closes[-1] < session_close:
+            closes.append(session_close)
+        return closes
+
+    def next_run(self, now: pd.Timestamp = None) -> pd.Timestamp:
+        now = pd.Timestamp.now(tz=NY_TIMEZONE) if now is None else now
+        session_open, session_close = self.calendar.next_session(now - self.settle)
+        while True:
+            for bar_close in self._bar_closes(session_open, session_close):
+                if bar_close + self.settle > now:
+                    return bar_close + self.settle
+            session_open, session_close = self.calendar.next_session(session_close + pd.Timedelta(seconds=1))
+
+    @staticmethod
+    def sleep_until(wake: pd.Timestamp):
+        while True:
+            remaining = (wake - pd.Timestamp.now(tz=wake.tz)).total_seconds()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, _MAX_SLEEP_S))
+
+    def wait_for_next_bar(self, stop_at: pd.Timestamp = None) -> bool:
+        """Sleeps until the next bar close + settle. Returns False without sleeping if that is after stop_at"""
+        wake = self.next_run()
+        if stop_at is not None and wake > stop_at:
+            return False
+        self.sleep_until(wake)
+        return True
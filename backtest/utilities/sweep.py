@@ -0,0 +1,75 @@
+import concurrent.futures as fut
+import copy
+import multiprocessing
+from typing import Callable, List
+
+import numpy as np
+import pandas as pd
+
+# populated in the parent before the pool forks so workers inherit it instead of re-pickling per task
+_SWEEP_STATE = {}
+
+
+def _shared_arrays(obj, memo: dict, seen: set):
+    """Maps id -> object for every ndarray/DataFrame/Series reachable from obj through containers and attributes"""
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        # shared by every run of this worker, so writes have to fail instead of leaking into the next run
+        obj.setflags(write=False)
+        memo[id(obj)] = obj
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        memo[id(obj)] = obj
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _shared_arrays(v, memo, seen)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _shared_arrays(v, memo, seen)
+    elif hasattr(obj, "__dict__"):
+        _shared_arrays(vars(obj), memo, seen)
+
+
+def fork_data_provider(data_provider):
+    """
+    Copy of data_provider whose cursor/state is its own but whose loaded arrays and frames are the loaded ones,
+    so forked workers keep sharing their pages copy-on-write with the parent. The arrays are made read-only.
+    """
+    memo = {}
+    _shared_arrays(data_provider, memo, set())
+    return copy.deepcopy(data_provider, memo)
+
+
+def _run_sweep_entry(run_idx: int, overrides: dict) -> dict:
+    # fresh args/strategy/portfolio and data provider cursor per run, the bars themselves are shared
+    args = copy.deepcopy(_SWEEP_STATE["args"])
+    # per-run output files (trade log, profile) are tagged with the run index unless overrides set run_tag
+    args.run_tag = run_idx
+    for k, v in overrides.items():
+        setattr(args, k, v)
+    data_provider = fork_data_provider(_SWEEP_STATE["data_provider"])
+    stats = _SWEEP_STATE["run_fn"](args, data_provider)
+    return dict(run=run_idx, **overrides, **stats)
+
+
+def run_sweep(
+    args, load_fn: Callable, run_fn: Callable, run_overrides: List[dict], num_workers: int = 4
+) -> pd.DataFrame:
+    """
+    Runs len(run_overrides) backtests, paying the market data load only once.
+
+    load_fn(args) -> data_provider is called once in the parent. Workers are forked so they share the
+    loaded bars copy-on-write and only receive (run_idx, overrides) per task. overrides are set on each run's args.
+    run_fn(args, data_provider) -> dict of summary stats, one row of the returned results table.
+    """
+    _SWEEP_STATE["args"] = args
+    _SWEEP_STATE["run_fn"] = run_fn
+    _SWEEP_STATE["data_provider"] = load_fn(args)
+    try:
+        with fut.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")) as e:
+            processes = [e.submit(_run_sweep_entry, i, overrides) for i, overrides in enumerate(run_overrides)]
+            results = [p.result() for p in processes]
+    finally:
+        _SWEEP_STATE.clear()
+    return pd.DataFrame(results).set_index("run")
@@ -1,13 +1,19 @@
 import datetime
+import hashlib
+import io
 import json
 import argparse
 import logging
 import os
 import random
+import time
 from pathlib import Path
+from typing import List, Optional
 
 import pandas as pd
-from sqlalchemy import create_engine
+import psycopg2
+from psycopg2 import sql
+from sqlalchemy import create_engine, text
 
 from trading.utilities.utils import FORMAT_YYYYMMDD, NY_TIMEZONE, timestamp_to_ms
 
@@ -16,11 +22,15 @@ MODELINFO_DIR = UTILS_ABS_FP / "../../Data/strategies"
 OPTION_METADATA_PATH = Path(f"{os.environ['DATA_DIR']}/options/metadata.csv.gz")
 DATA_GETTER_INST_TYPES = ['equity', 'options']
 DATA_GETTER_DEFAULT_START_DT = datetime.datetime(2019, 6, 1)
+SQL_CACHE_DIR = Path(f"{os.environ['DATA_DIR']}/sql_cache")
+# (schema, table, conflict_cols) whose unique index bulk_upsert already ensured in this process
+_UNIQUE_INDEXES = set()
 
 
 
 def log_message(message: str):
-    logging.info(f"{pd.Timestamp.now()}: {message}")
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("%s: %s", pd.Timestamp.now(), message)
 
 
 def parse_args():
@@ -31,8 +41,32 @@ def parse_args():
                         default='equity', choices=DATA_GETTER_INST_TYPES)
     parser.add_argument("--num-runs", type=int, default=1,
                         help="Run backtest x times, get more aggregated performance details from log")
+    parser.add_argument("--num-workers", type=int, default=4,
+                        help="Number of processes used when --num-runs > 1 or --optimize")
+    parser.add_argument("--optimize", type=str, required=False, default=None, choices=["grid", "random", "halving"],
+                        help="Search PARAM_SPACE of the config instead of a single run")
+    parser.add_argument("--num-candidates", type=int, required=False, default=None,
+                        help="Number of parameter sets sampled for --optimize random/halving")
+    parser.add_argument("--profile-sample-every", type=int, default=0,
+                        help="Time 1 in N events of the event loop and dump per-stage latencies. 0 disables")
+    parser.add_argument("--journal-level", type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "OFF"],
+                        help="Level of the per-run order/fill journal. DEBUG also records every bar")
+    parser.add_argument("--journal-format", type=str, default="jsonl", choices=["jsonl", "pickle"])
     parser.add_argument("--start-ms", type=int, required=False,
                         help="Specific start time in ms")
+    parser.add_argument("--end-ms", type=int, required=False,
+                        help="Specific end time in ms, defaults to now")
+    parser.add_argument("--replay", action="store_true", default=False,
+                        help="Serve historical bars from a compiled memory-mapped replay file instead of the DB")
+    parser.add_argument("--replay-frequency", type=str, default="15 mins",
+                        help="Bar frequency compiled for --replay, as stored in ibkr.market_data_bars_uniq")
+    parser.add_argument("--from-disk", type=str, default=None, choices=["csv", "csv.gz", "parquet"],
+                        help="Serve historical bars of --frequency from get_data's files in this store format")
+    parser.add_argument("--frequency", type=str, default="5minute",
+                        help="Bar frequency live loops wake up on and --from-disk reads, eg 5minute, 15minute, day")
+    parser.add_argument("--settle-seconds", type=float, default=None,
+                        help="Seconds after each bar close before live loops process it, defaults to 5 for the "
+                             "broker feed and to scheduler.DISK_READ_SETTLE for loops reading get_data's files")
     parser.add_argument("--config-name", type=str, required=True)
     return parser.parse_args()
 
@@ -41,8 +75,131 @@ def remove_bs(s: str):
     # remove backslash at the end from reading from a stock_list.txt
     return s.replace("\n", "")
 
+_DB_ENGINE = None
+_DB_ENGINE_PID = None
+
+
+def _dispose_inherited_engine():
+    # a forked child must not reuse the parent's pooled connections, drop them without closing the sockets
+    global _DB_ENGINE, _DB_ENGINE_PID
+    if _DB_ENGINE is not None and _DB_ENGINE_PID != os.getpid():
+        _DB_ENGINE.dispose(close=False)
+        _DB_ENGINE, _DB_ENGINE_PID = None, None
+
+
+os.register_at_fork(after_in_child=_dispose_inherited_engine)
+
+
 def get_db_engine():
-    return create_engine(os.environ['DB_URL'])
+    """Process-wide pooled engine, recreated once per forked process"""
+    global _DB_ENGINE, _DB_ENGINE_PID
+    _dispose_inherited_engine()
+    if _DB_ENGINE is None:
+        _DB_ENGINE = create_engine(os.environ['DB_URL'], pool_pre_ping=True)
+        _DB_ENGINE_PID = os.getpid()
+    return _DB_ENGINE
+
+
+def read_sql_cached(
+    query: str, params: Optional[dict] = None, ttl: Optional[datetime.timedelta] = None, refresh: bool = False
+) -> pd.DataFrame:
+    """
+    pd.read_sql for read-only historical queries, cached on disk under DATA_DIR/sql_cache keyed by query and params.
+    Bound the query's time range explicitly in params so the key pins the window it covers.
+    Cached results older than ttl are re-queried, ttl=None never expires. refresh=True re-queries regardless.
+    """
+    key = hashlib.sha1(json.dumps([query, params], sort_keys=True, default=str).encode()).hexdigest()
+    cache_fp = SQL_CACHE_DIR / f"{key}.pkl"
+    if not refresh and cache_fp.exists() and (
+        ttl is None or time.time() - cache_fp.stat().st_mtime < ttl.total_seconds()
+    ):
+        return pd.read_pickle(cache_fp)
+    df = pd.read_sql(text(query), get_db_engine(), params=params)
+    SQL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_fp = cache_fp.with_suffix(f".{os.getpid()}.tmp")
+    df.to_pickle(tmp_fp)
+    os.replace(tmp_fp, cache_fp)
+    return df
+
+
+def ensure_unique_index(cur, schema: str, name: str, conflict_cols: List[str]):
+    """ON CONFLICT (conflict_cols) needs a unique index over exactly those columns, create it if missing"""
+    index_name = f"{name}_{'_'.join(conflict_cols)}_uniq"
+    if (schema, name, tuple(conflict_cols)) in _UNIQUE_INDEXES:
+        return
+    try:
+        cur.execute(
+            sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})").format(
+                sql.Identifier(index_name),
+                sql.Identifier(schema, name),
+                sql.SQL(", ").join(map(sql.Identifier, conflict_cols)),
+            )
+        )
+    except psycopg2.Error as e:
+        raise Exception(
+            f"bulk_upsert into {schema}.{name} needs a unique index on {conflict_cols} and creating {index_name} failed"
+            f" (duplicate {conflict_cols} rows already in the table have to be removed first): {e}"
+        ) from e
+    _UNIQUE_INDEXES.add((schema, name, tuple(conflict_cols)))
+
+
+def bulk_upsert(df, table: str, conflict_cols: List[str], update_cols: Optional[List[str]] = None, engine=None) -> int:
+    """
+    COPYs df (pandas or polars) into a temp staging table and merges it into schema.table with
+    INSERT ... ON CONFLICT (conflict_cols), so write time depends on the new rows only.
+    Conflicting rows are skipped, or have update_cols overwritten if given. The unique index on conflict_cols
+    ON CONFLICT relies on is created on first use.
+    All identifiers are quoted, so df column names have to match the table's (lowercase) column names.
+    Returns the number of rows inserted or updated.
+    """
+    if len(df) == 0:
+        return 0
+    engine = get_db_engine() if engine is None else engine
+    schema, name = table.split(".")
+    cols = sql.SQL(", ").join(map(sql.Identifier, df.columns))
+    staging = sql.Identifier(f"_staging_{name}")
+    if update_cols:
+        conflict_action = sql.SQL("DO UPDATE SET {}").format(
+            sql.SQL(", ").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in update_cols)
+        )
+    else:
+        conflict_action = sql.SQL("DO NOTHING")
+
+    buf = io.StringIO()
+    if hasattr(df, "write_csv"):
+        df.write_csv(buf, include_header=False)
+    else:
+        df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            ensure_unique_index(cur, schema, name, conflict_cols)
+            cur.execute(
+                sql.SQL("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+                    staging, sql.Identifier(schema, name)
+                )
+            )
+            cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(staging, cols), buf)
+            cur.execute(
+                sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) {}").format(
+                    sql.Identifier(schema, name),
+                    cols,
+                    cols,
+                    staging,
+                    sql.SQL(", ").join(map(sql.Identifier, conflict_cols)),
+                    conflict_action,
+                )
+            )
+            num_rows = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return num_rows
 
 def read_universe(universe_fp):
     with open(universe_fp, "r") as fin:
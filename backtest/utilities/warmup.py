@@ -0,0 +1,76 @@
+import datetime
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Iterator, List
+
+import pandas as pd
+from sqlalchemy import text
+
+from backtest.utilities.utils import get_db_engine, get_ms_from_datetime, log_message
+
+WARMUP_SNAPSHOT_DIR = Path(os.environ["DATA_DIR"]) / "warmup"
+_WARMUP_QUERY = """
+    SELECT * FROM ibkr.market_data_bars_uniq
+    WHERE frequency = :frequency
+        and symbol = ANY(:symbols)
+        and timestamp >= :start_ms
+    order by timestamp;
+"""
+
+
+def stream_bars(symbols: List[str], frequency: str, start_ms: int, chunksize: int = 50_000) -> Iterator[pd.DataFrame]:
+    """Yields bars in timestamp order through a server-side cursor, holding at most chunksize rows at a time"""
+    with get_db_engine().connect().execution_options(stream_results=True, max_row_buffer=chunksize) as conn:
+        yield from pd.read_sql(
+            text(_WARMUP_QUERY),
+            conn,
+            params=dict(frequency=frequency, symbols=list(symbols), start_ms=int(start_ms)),
+            chunksize=chunksize,
+        )
+
+
+def _params_repr(params: dict) -> str:
+    return repr(sorted((k, repr(v)) for k, v in params.items()))
+
+
+def warmup_strategy(strategy, symbols: List[str], frequency: str, lookback: datetime.timedelta, snapshot_name: str,
+                    params: dict):
+    """
+    Warms up strategy with the last lookback of bars for symbols, chunk by chunk. strategy.warmup(chunk) must
+    therefore be incremental: it is called once per chunk of at most chunksize bars, in timestamp order, and
+    each call has to extend the state of the previous ones rather than reset it.
+    params are the kwargs strategy was constructed with. They are part of the snapshot key and stored in the
+    snapshot, so a config change never resumes a strategy warmed up with the old parameters.
+    The warmed strategy is snapshotted with its last bar timestamp, so a restart only replays the bars since
+    the snapshot. Returns the warmed strategy, which is the unpickled snapshot when one is reused.
+    """
+    params_repr = _params_repr(params)
+    key = hashlib.sha1(
+        f"{type(strategy).__name__}|{params_repr}|{sorted(symbols)}|{frequency}|{lookback}".encode()
+    ).hexdigest()[:12]
+    snapshot_fp = WARMUP_SNAPSHOT_DIR / f"{snapshot_name}_{key}.pkl"
+    start_ms = get_ms_from_datetime(datetime.datetime.now() - lookback)
+    if snapshot_fp.exists():
+        with open(snapshot_fp, "rb") as fin:
+            snapshot = pickle.load(fin)
+        if snapshot.get("params") != params_repr:
+            log_message(f"warmup: ignoring snapshot {snapshot_fp}, built with different params")
+        elif snapshot["last_timestamp"] >= start_ms:
+            strategy, start_ms = snapshot["strategy"], snapshot["last_timestamp"] + 1
+            log_message(f"warmup: resuming snapshot {snapshot_fp} from {start_ms}")
+
+    last_timestamp, num_bars = start_ms - 1, 0
+    for chunk in stream_bars(symbols, frequency, start_ms):
+        strategy.warmup(chunk)
+        last_timestamp = int(chunk["timestamp"].max())
+        num_bars += len(chunk)
+    log_message(f"warmup: replayed {num_bars} bars up to {last_timestamp}")
+
+    WARMUP_SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_fp = snapshot_fp.with_suffix(".tmp")
+    with open(tmp_fp, "wb") as fout:
+        pickle.dump(dict(strategy=strategy, last_timestamp=last_timestamp, params=params_repr), fout)
+    os.replace(tmp_fp, snapshot_fp)
+    return strategy
@@ -10,9 +10,9 @@ import pandas as pd
 from pathlib import Path
 
 from Inform.telegram import telegram_bot_sendtext
+from backtest.utilities.scheduler import DISK_READ_SETTLE, DOWNLOAD_SETTLE, BarScheduler, end_of_trading_week
 from backtest.utilities.utils import (
     generate_start_date_in_ms,
-    get_sleep_time,
     load_credentials,
     log_message,
     parse_args,
@@ -58,18 +58,19 @@ def run(args, creds, strategy):
     portfolio.set_keep_historical_data_period(int(1e6))
 
     signals = queue.Queue()
+    # live bars come from the files get_data writes, so wait until its download after the same bar close is done
+    settle = DISK_READ_SETTLE if args.settle_seconds is None else datetime.timedelta(seconds=args.settle_seconds)
+    if args.live and settle <= DOWNLOAD_SETTLE:
+        log_message(f"settle {settle} is not after get_data's download settle {DOWNLOAD_SETTLE}, bars will lag by one")
+    scheduler = BarScheduler(args.frequency, settle=settle)
     start = time.time()
     while True:
-        now = pd.Timestamp.now(tz=NY_TIMEZONE)
-        time_since_midnight = now - now.normalize()
-        if args.live and ((now.dayofweek == 4 and now.hour > 17) or now.dayofweek > 4):
-            break
-        elif args.live and (
-            time_since_midnight < datetime.timedelta(hours=9, minutes=45)
-            or time_since_midnight > datetime.timedelta(hours=17, minutes=45)
-        ):
-            time.sleep(60)
-            continue
+        if args.live:
+            now = pd.Timestamp.now(tz=NY_TIMEZONE)
+            log_message(f"[{datetime.datetime.now()}] sleeping until {scheduler.next_run(now)}")
+            if not scheduler.wait_for_next_bar(stop_at=end_of_trading_week(now)):
+                break
+            log_message(f"[{datetime.datetime.now()}] sleep over")
         if bars.continue_backtest == True:
             log_message(f"{pd.Timestamp.now(tz=NY_TIMEZONE)}: update_bars")
             bars.update_bars(event_queue)
@@ -93,9 +94,6 @@ def run(args, creds, strategy):
                 res = telegram_bot_sendtext(
                     f"{args.frequency}\n{signal_event.details()}", creds["TELEGRAM_APIKEY"], creds["TELEGRAM_CHATID"]
                 )
-            log_message(f"[{datetime.datetime.now()}] sleeping")
-            time.sleep(get_sleep_time(args.frequency))
-            log_message(f"[{datetime.datetime.now()}] sleep over")
 
     signals = list(signals.queue)
     print(
@@ -1,26 +1,63 @@
+import datetime
 import importlib
 import json
 import os
 import logging
 import os
-import concurrent.futures as fut
+import random
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 
 from backtest.utilities.backtest import Backtest
-from backtest.utilities.utils import generate_start_date_in_ms, parse_args, load_credentials, read_universe_list
+from backtest.utilities.bar_merge import MergedBarHandler
+from backtest.utilities.optimize import optimize
+from backtest.utilities.replay import ReplayDataHandler
+from backtest.utilities.sweep import run_sweep
+from backtest.utilities.utils import (
+    DATA_GETTER_DEFAULT_START_DT,
+    generate_start_date_in_ms,
+    get_ms_from_datetime,
+    load_credentials,
+    log_message,
+    parse_args,
+    read_universe_list,
+)
 from trading.broker.broker import SimulatedBroker
 from trading.data.dataHandler import DBDataHandler
 
 
-def main(args):
-    creds = args.creds
+def load_data_provider(args) -> DBDataHandler:
     with open(args.data_config_fp, 'r') as fin:
         data_config = json.load(fin)
 
     symbol_list = [c["symbol"] for c in data_config["contracts"]]
-    bars = DBDataHandler(symbol_list, data_config, creds)
+    if args.replay or args.from_disk is not None:
+        start_ms = args.start_ms if args.start_ms is not None else get_ms_from_datetime(DATA_GETTER_DEFAULT_START_DT)
+        end_ms = args.end_ms if args.end_ms is not None else get_ms_from_datetime(datetime.datetime.now())
+        if args.replay:
+            return ReplayDataHandler(symbol_list, args.replay_frequency, start_ms, end_ms)
+        # one MarketBatchEvent per timestamp merged from get_data's per-symbol files
+        return MergedBarHandler.from_disk(symbol_list, args.frequency, start_ms, end_ms, store_format=args.from_disk)
+    return DBDataHandler(symbol_list, data_config, args.creds)
+
+
+def get_run_overrides(args) -> list:
+    """Each sweep run starts at its own random time in the first half of the loaded window"""
+    start_ms = args.start_ms if args.start_ms is not None else get_ms_from_datetime(DATA_GETTER_DEFAULT_START_DT)
+    end_ms = args.end_ms if args.end_ms is not None else get_ms_from_datetime(datetime.datetime.now())
+    return [dict(run_start_ms=random.randint(start_ms, (start_ms + end_ms) // 2)) for _ in range(args.num_runs)]
+
+
+def main(args, bars=None) -> dict:
+    if bars is None:
+        bars = load_data_provider(args)
+    run_start_ms = getattr(args, "run_start_ms", None)
+    if run_start_ms is not None:
+        if hasattr(bars, "seek"):
+            bars.seek(run_start_ms)
+        else:
+            log_message(f"{type(bars).__name__} cannot seek, run starts at the data start instead of {run_start_ms}")
     setattr(args, "data_provider", bars)
     broker = SimulatedBroker(bars, args.portfolio, gatekeepers=args.gk)
     setattr(args, "broker", broker)
@@ -42,6 +79,7 @@ def main(args):
     if bt.show_plot:
         plt.legend()
         plt.show()
+    return bt.metrics.summary()
 
 
 if __name__ == "__main__":
@@ -55,6 +93,17 @@ if __name__ == "__main__":
         logging.basicConfig(
             filename=Path(os.environ["DATA_DIR"]) / f"logging/{args.name}.log", level=logging.INFO, force=True
         )
-    with fut.ProcessPoolExecutor(4) as e:
-        processes = [e.submit(main, args) for _ in range(args.num_runs)]
-        processes = [p.result() for p in processes]
+    if args.optimize is not None:
+        results_df = optimize(
+            args, load_data_provider, main, args.optimize, args.num_candidates, num_workers=args.num_workers
+        )
+        print(results_df.head(20))
+        if args.name != "":
+            results_df.to_csv(Path(os.environ["DATA_DIR"]) / f"logging/{args.name}_optimize.csv", index=False)
+    elif args.num_runs == 1:
+        main(args)
+    else:
+        results_df = run_sweep(args, load_data_provider, main, get_run_overrides(args), args.num_workers)
+        print(results_df.describe())
+        if args.name != "":
+            results_df.to_csv(Path(os.environ["DATA_DIR"]) / f"logging/{args.name}_runs.csv")